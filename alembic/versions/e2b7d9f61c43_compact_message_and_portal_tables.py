@@ -0,0 +1,71 @@
+"""Use surrogate portal keys in message table and add lookup indexes
+
+Revision ID: e2b7d9f61c43
+Revises: c81f3e4a9d27
+Create Date: 2019-10-09 21:37:05.904118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b7d9f61c43'
+down_revision = 'c81f3e4a9d27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('portal_new',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('twid', sa.String(length=127), nullable=False),
+    sa.Column('mxid', sa.String(length=255), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('twid', name='portal_twid_key'),
+    sa.UniqueConstraint('mxid', name='portal_mxid_key')
+    )
+    op.execute("INSERT INTO portal_new (twid, mxid) SELECT twid, mxid FROM portal")
+    # Messages whose portal row is missing would be dropped by the JOIN below, so give them
+    # a portal without a room instead.
+    op.execute("INSERT INTO portal_new (twid) SELECT DISTINCT tw_receiver FROM message "
+               "WHERE tw_receiver NOT IN (SELECT twid FROM portal_new)")
+    op.create_table('message_new',
+    sa.Column('portal_id', sa.Integer(), nullable=False),
+    sa.Column('twid', sa.String(length=127), nullable=False),
+    sa.Column('mxid', sa.String(length=255), nullable=True),
+    sa.ForeignKeyConstraint(['portal_id'], ['portal_new.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('portal_id', 'twid')
+    )
+    op.execute("INSERT INTO message_new (portal_id, twid, mxid) "
+               "SELECT portal_new.id, message.twid, message.mxid "
+               "FROM message JOIN portal_new ON portal_new.twid = message.tw_receiver")
+    op.drop_table('message')
+    op.drop_table('portal')
+    op.rename_table('portal_new', 'portal')
+    op.rename_table('message_new', 'message')
+    op.create_index('message_portal_mxid_idx', 'message', ['portal_id', 'mxid'], unique=False)
+
+
+def downgrade():
+    op.drop_index('message_portal_mxid_idx', table_name='message')
+    op.create_table('message_old',
+    sa.Column('mxid', sa.String(length=255), nullable=True),
+    sa.Column('mx_room', sa.String(length=255), nullable=True),
+    sa.Column('tw_receiver', sa.String(length=127), nullable=False),
+    sa.Column('twid', sa.String(length=127), nullable=False),
+    sa.PrimaryKeyConstraint('tw_receiver', 'twid')
+    )
+    op.execute("INSERT INTO message_old (mxid, mx_room, tw_receiver, twid) "
+               "SELECT message.mxid, portal.mxid, portal.twid, message.twid "
+               "FROM message JOIN portal ON portal.id = message.portal_id")
+    op.create_table('portal_old',
+    sa.Column('twid', sa.String(length=127), nullable=False),
+    sa.Column('mxid', sa.String(length=255), nullable=True),
+    sa.PrimaryKeyConstraint('twid')
+    )
+    op.execute("INSERT INTO portal_old (twid, mxid) SELECT twid, mxid FROM portal")
+    op.drop_table('message')
+    op.drop_table('portal')
+    op.rename_table('portal_old', 'portal')
+    op.rename_table('message_old', 'message')
@@ -0,0 +1,62 @@
+"""Realistic message payloads shared by the benchmarks."""
+from typing import Dict
+from urllib.parse import urlencode
+
+SHORT_PLAIN = "Hi! Is my order #4521 on its way? Thanks"
+
+FORWARDED_LONG = "\n".join([
+    "Forwarded message",
+    "",
+    "Dear customer, thank you for contacting us. Your request has been received and one of our "
+    "agents will get back to you within 24 hours. Please keep your reference number at hand "
+    "when you contact us again, it speeds things up for everyone involved.",
+] * 25)
+
+EMOJI_HEAVY = ("Thanks so much 🙏🙏 the package arrived 📦✨ and everything is perfect 😍😍😍 "
+               "see you next time 👋🏽🇫🇮 ❤️‍🔥 ") * 10
+
+FORMATTED = ("*Order update*: your order _#4521_ has been ~cancelled~ *shipped*. "
+             "Tracking code: ```FI1234567890``` - reply _HELP_ for help.\n") * 10
+
+WHATSAPP_TEXTS = {
+    "short_plain": SHORT_PLAIN,
+    "forwarded_long": FORWARDED_LONG,
+    "emoji_heavy": EMOJI_HEAVY,
+    "formatted": FORMATTED,
+}
+
+SIMPLE_HTML = "Your code is <strong>123456</strong>, it expires in <em>10 minutes</em>."
+
+NESTED_HTML = ("<blockquote><p>In reply to <a href='https://matrix.to/#/@alice:example.com'>"
+               "Alice</a></p><p>Can you <strong>check <em>the <del>old</del> order</em></strong>"
+               " please?</p></blockquote><ul><li>First <code>item</code></li><li>Second item"
+               "<ol><li>Nested <strong>one</strong></li><li>Nested two</li></ol></li></ul>"
+               "<pre><code class='language-json'>{\"order\": 4521}</code></pre>") * 5
+
+MATRIX_HTML = {
+    "simple": SIMPLE_HTML,
+    "nested": NESTED_HTML,
+}
+
+WEBHOOK_URL = "https://bridge.example.com/_twilio/receive"
+WEBHOOK_TOKEN = "0123456789abcdef0123456789abcdef"
+
+MESSAGE_WEBHOOK: Dict[str, str] = {
+    "ToCountry": "US", "ToState": "", "SmsMessageSid": "SM" + "a" * 32, "NumMedia": "2",
+    "ToCity": "", "FromZip": "", "SmsSid": "SM" + "a" * 32, "FromState": "",
+    "SmsStatus": "received", "FromCity": "", "Body": EMOJI_HEAVY, "FromCountry": "FI",
+    "To": "whatsapp:+15550001234", "ToZip": "", "NumSegments": "3",
+    "MessageSid": "SM" + "a" * 32, "AccountSid": "AC" + "b" * 32,
+    "From": "whatsapp:+358401234567", "ApiVersion": "2010-04-01",
+    "MediaContentType0": "image/jpeg",
+    "MediaUrl0": "https://api.twilio.com/2010-04-01/Accounts/AC/Messages/MM/Media/ME0",
+    "MediaContentType1": "application/pdf",
+    "MediaUrl1": "https://api.twilio.com/2010-04-01/Accounts/AC/Messages/MM/Media/ME1",
+}
+MESSAGE_WEBHOOK_BODY = urlencode(MESSAGE_WEBHOOK).encode("utf-8")
+
+STATUS_WEBHOOK: Dict[str, str] = {
+    "SmsSid": "SM" + "c" * 32, "SmsStatus": "read", "MessageStatus": "read",
+    "EventType": "READ", "To": "whatsapp:+358401234567", "MessageSid": "SM" + "c" * 32,
+    "AccountSid": "AC" + "b" * 32, "From": "whatsapp:+15550001234", "ApiVersion": "2010-04-01",
+}
@@ -0,0 +1,154 @@
+"""
+A stand-in for the homeserver, used by the load test. It implements just enough of the
+client-server and media APIs for the bridge to create portals, send messages, upload media and
+send read receipts. Every user is considered joined to every room with the highest power level.
+"""
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Pattern, Tuple
+from itertools import count
+import asyncio
+import json
+import re
+
+from aiohttp import web
+
+JSON = Dict[str, Any]
+Handler = Callable[[web.Request, JSON, Tuple[str, ...]], Awaitable[JSON]]
+
+CLIENT = r"_matrix/client/r0"
+ROOM = rf"{CLIENT}/rooms/([^/]+)"
+
+
+class FakeHomeserver:
+    """
+    Fake homeserver. ``on_message`` is called with the room ID and content of every
+    ``m.room.message`` event the bridge sends, and ``on_receipt`` with the user ID and event ID
+    of every read receipt.
+    """
+    loop: asyncio.AbstractEventLoop
+    app: web.Application
+
+    domain: str
+    bot_mxid: str
+    delay: float
+
+    on_message: Callable[[str, JSON], None]
+    on_receipt: Callable[[str, str], None]
+    requests: Dict[str, int]
+
+    _routes: List[Tuple[str, Pattern, Handler]]
+    _ids: count
+
+    def __init__(self, domain: str, bot_localpart: str, delay: float = 0,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.loop = loop or asyncio.get_event_loop()
+        self.domain = domain
+        self.bot_mxid = f"@{bot_localpart}:{domain}"
+        self.delay = delay
+        self.on_message = lambda room_id, content: None
+        self.on_receipt = lambda user_id, event_id: None
+        self.requests = {}
+        self._ids = count(1)
+        self._routes = [(method, re.compile(path), handler) for method, path, handler in (
+            ("GET", r"_matrix/client/versions", self.versions),
+            ("GET", rf"{CLIENT}/account/whoami", self.whoami),
+            ("POST", rf"{CLIENT}/register", self.register),
+            ("POST", rf"{CLIENT}/createRoom", self.create_room),
+            ("POST", rf"{CLIENT}/join/([^/]+)", self.join),
+            ("POST", rf"{ROOM}/join", self.join),
+            ("GET", rf"{ROOM}/state/m\.room\.power_levels/?", self.power_levels),
+            ("GET", rf"{ROOM}/state/m\.room\.member/([^/]+)", self.member),
+            ("GET", rf"{ROOM}/joined_members", self.joined_members),
+            ("PUT", rf"{ROOM}/state/.+", self.send_event),
+            ("PUT", rf"{ROOM}/send/([^/]+)/[^/]+", self.send_message),
+            ("POST", rf"{ROOM}/read_markers", self.read_markers),
+            ("POST", rf"{ROOM}/receipt/m\.read/([^/]+)", self.receipt),
+            ("POST", r"_matrix/media/r0/upload", self.upload),
+        )]
+        self.app = web.Application()
+        self.app.router.add_route("*", "/{path:.*}", self.handle)
+
+    def _event_id(self) -> str:
+        return f"$fake{next(self._ids)}:{self.domain}"
+
+    async def handle(self, request: web.Request) -> web.Response:
+        path = request.match_info["path"]
+        for method, pattern, handler in self._routes:
+            if method != request.method:
+                continue
+            match = pattern.fullmatch(path)
+            if match:
+                name = handler.__name__
+                break
+        else:
+            match, handler, name = None, None, "other"
+        self.requests[name] = self.requests.get(name, 0) + 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if handler is None:
+            # Typing notifications, profile updates, invites and so on
+            await request.read()
+            return web.json_response({})
+        user_id = request.query.get("user_id", self.bot_mxid)
+        if handler == self.upload:
+            return web.json_response(await self.upload(request, {}, (user_id,)))
+        body = await request.read()
+        try:
+            content = json.loads(body) if body else {}
+        except ValueError:
+            return web.json_response({"errcode": "M_NOT_JSON", "error": "Content not JSON."},
+                                     status=400)
+        return web.json_response(await handler(request, content, (user_id, *match.groups())))
+
+    async def versions(self, _: web.Request, __: JSON, ___: Tuple[str, ...]) -> JSON:
+        return {"versions": ["r0.5.0"]}
+
+    async def whoami(self, _: web.Request, __: JSON, args: Tuple[str, ...]) -> JSON:
+        user_id, = args
+        return {"user_id": user_id}
+
+    async def register(self, _: web.Request, content: JSON, __: Tuple[str, ...]) -> JSON:
+        return {"user_id": f"@{content.get('username', '')}:{self.domain}"}
+
+    async def create_room(self, _: web.Request, __: JSON, ___: Tuple[str, ...]) -> JSON:
+        return {"room_id": f"!fake{next(self._ids)}:{self.domain}"}
+
+    async def join(self, _: web.Request, __: JSON, args: Tuple[str, ...]) -> JSON:
+        _, room_id = args
+        return {"room_id": room_id}
+
+    async def power_levels(self, _: web.Request, __: JSON, ___: Tuple[str, ...]) -> JSON:
+        return {"users_default": 100, "events_default": 0, "state_default": 0, "users": {},
+                "events": {}}
+
+    async def member(self, _: web.Request, __: JSON, args: Tuple[str, ...]) -> JSON:
+        _, _, user_id = args
+        return {"membership": "join", "displayname": user_id[1:user_id.index(":")]}
+
+    async def joined_members(self, _: web.Request, __: JSON, ___: Tuple[str, ...]) -> JSON:
+        return {"joined": {}}
+
+    async def send_event(self, _: web.Request, __: JSON, ___: Tuple[str, ...]) -> JSON:
+        return {"event_id": self._event_id()}
+
+    async def send_message(self, _: web.Request, content: JSON, args: Tuple[str, ...]) -> JSON:
+        _, room_id, event_type = args
+        if event_type == "m.room.message":
+            self.on_message(room_id, content)
+        return {"event_id": self._event_id()}
+
+    async def read_markers(self, _: web.Request, content: JSON, args: Tuple[str, ...]) -> JSON:
+        user_id, _ = args
+        if "m.read" in content:
+            self.on_receipt(user_id, content["m.read"])
+        return {}
+
+    async def receipt(self, _: web.Request, __: JSON, args: Tuple[str, ...]) -> JSON:
+        user_id, _, event_id = args
+        self.on_receipt(user_id, event_id)
+        return {}
+
+    async def upload(self, request: web.Request, _: JSON, __: Tuple[str, ...]) -> JSON:
+        # Read the upload in chunks like a real server, without holding all of it in memory
+        async for _ in request.content.iter_chunked(64 * 1024):
+            pass
+        return {"content_uri": f"mxc://{self.domain}/fake{next(self._ids)}"}
@@ -0,0 +1,144 @@
+"""
+A stand-in for the Twilio REST API, used by the load test. It accepts messages posted to
+Messages.json, serves media for inbound messages and sends signed status callbacks for every
+accepted message, like Twilio does when a status callback URL is configured for the sender.
+"""
+from typing import Callable, Dict, Iterable, Optional, Set
+from hashlib import sha1
+from uuid import uuid4
+import asyncio
+import base64
+import hmac
+
+from aiohttp import web, ClientError, ClientSession
+from yarl import URL
+
+API_PATH = "/2010-04-01"
+
+
+def sign(secret: str, url: str, params: Dict[str, str]) -> str:
+    """Compute the X-Twilio-Signature header Twilio would send for a form POST to the URL."""
+    signing_url = str(URL(url).with_scheme("https").with_port(None))
+    data = signing_url + "".join(key + value for key, value in sorted(params.items()))
+    return base64.b64encode(hmac.new(secret.encode("utf-8"), data.encode("utf-8"), sha1).digest()
+                            ).decode("utf-8")
+
+
+async def post_signed(http: ClientSession, secret: str, url: str, params: Dict[str, str]
+                      ) -> int:
+    headers = {"X-Twilio-Signature": sign(secret, url, params)}
+    async with http.post(url, data=params, headers=headers) as resp:
+        await resp.read()
+        return resp.status
+
+
+class FakeTwilio:
+    """
+    Fake Twilio API. ``on_message`` is called with the body (or the media URL) of every message
+    the bridge sends, and ``on_status`` with the same text and the status right before each
+    status callback is sent.
+    """
+    loop: asyncio.AbstractEventLoop
+    app: web.Application
+    http: Optional[ClientSession]
+
+    account_id: str
+    secret: str
+    sender_id: str
+    status_url: str
+    statuses: Iterable[str]
+    status_delay: float
+    delay: float
+    media_size: int
+
+    on_message: Callable[[str], None]
+    on_status: Callable[[str, str], None]
+    status_errors: int
+
+    _tasks: Set[asyncio.Task]
+
+    def __init__(self, account_id: str, secret: str, sender_id: str, status_url: str,
+                 statuses: Iterable[str] = ("sent", "delivered", "read"),
+                 status_delay: float = 0.1, delay: float = 0, media_size: int = 64 * 1024,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.loop = loop or asyncio.get_event_loop()
+        self.account_id = account_id
+        self.secret = secret
+        self.sender_id = sender_id
+        self.status_url = status_url
+        self.statuses = tuple(statuses)
+        self.status_delay = status_delay
+        self.delay = delay
+        self.media_size = media_size
+        self.on_message = lambda text: None
+        self.on_status = lambda text, status: None
+        self.status_errors = 0
+        self.http = None
+        self._tasks = set()
+        self.app = web.Application()
+        self.app.router.add_post(f"{API_PATH}/Accounts/{account_id}/Messages.json",
+                                 self.send_message)
+        self.app.router.add_get("/media/{name}", self.get_media)
+        self.app.on_startup.append(self._start)
+        self.app.on_cleanup.append(self._stop)
+
+    async def _start(self, _: web.Application) -> None:
+        self.http = ClientSession(loop=self.loop)
+
+    async def _stop(self, _: web.Application) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.http.close()
+
+    async def send_message(self, request: web.Request) -> web.Response:
+        data = await request.post()
+        if "To" not in data or ("Body" not in data and "MediaUrl" not in data):
+            return web.json_response({"code": 21602, "message": "Message body is required.",
+                                      "status": 400}, status=400)
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        text = data.get("Body") or data.get("MediaUrl", "")
+        self.on_message(text)
+        sid = f"SM{uuid4().hex}"
+        if self.statuses:
+            task = self.loop.create_task(self._send_statuses(sid, data["To"], text))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return web.json_response({
+            "sid": sid,
+            "account_sid": self.account_id,
+            "from": self.sender_id,
+            "to": data["To"],
+            "body": data.get("Body", ""),
+            "status": "queued",
+            "num_media": "1" if "MediaUrl" in data else "0",
+            "api_version": API_PATH[1:],
+        }, status=201)
+
+    async def _send_statuses(self, sid: str, receiver: str, text: str) -> None:
+        for status in self.statuses:
+            await asyncio.sleep(self.status_delay)
+            params = {
+                "MessageSid": sid,
+                "SmsSid": sid,
+                "AccountSid": self.account_id,
+                "From": self.sender_id,
+                "To": receiver,
+                "MessageStatus": status,
+                "SmsStatus": status,
+                "ApiVersion": API_PATH[1:],
+            }
+            self.on_status(text, status)
+            try:
+                if await post_signed(self.http, self.secret, self.status_url, params) >= 400:
+                    self.status_errors += 1
+            except (ClientError, OSError):
+                self.status_errors += 1
+
+    async def get_media(self, request: web.Request) -> web.Response:
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        # Every file is different, so that the bridge's media cache doesn't skip the uploads
+        name = request.match_info["name"].encode("utf-8")
+        return web.Response(body=name.ljust(self.media_size, b"\0"), content_type="image/jpeg")
@@ -0,0 +1,552 @@
+"""
+End-to-end load test. Starts the bridge as a subprocess with a temporary configuration that
+points it at a fake Twilio API and a fake homeserver (see fake_twilio.py and fake_homeserver.py),
+then sends it signed Twilio webhooks and appservice transactions at a fixed rate and measures
+how long each message takes to come out on the other side:
+
+    twilio->matrix  webhook sent to the bridge  -> message sent to the homeserver
+    matrix->twilio  transaction sent to bridge  -> message posted to Messages.json
+    status          status callback sent        -> read receipt sent to the homeserver
+
+Delivered and read receipts are coalesced by the bridge, so only the last status of each burst
+gets a receipt, and the status latency includes twilio.status.coalesce_window.
+
+Before the measured run, one message is sent from each conversation to create the portals. Run
+from the repository root, since the configuration is based on example-config.yaml and the
+database is created with alembic.
+
+Usage: python -m benchmarks.load_test [--rate PER_SECOND] [--duration SECONDS]
+                                      [--mix KIND=WEIGHT,...] [--conversations N]
+                                      [--set KEY=VALUE ...] [--output FILE]
+"""
+from typing import Any, Dict, List, Optional, Tuple
+from collections import Counter, defaultdict
+import subprocess
+import argparse
+import platform
+import tempfile
+import asyncio
+import random
+import shutil
+import socket
+import signal
+import json
+import time
+import sys
+import os
+import re
+
+from aiohttp import web, ClientError, ClientSession, TCPConnector
+
+from mautrix_twilio.config import Config
+
+from .fake_homeserver import FakeHomeserver
+from .fake_twilio import FakeTwilio, post_signed
+from .suite import get_commit
+
+DOMAIN = "loadtest.local"
+SENDER = f"@loadtester:{DOMAIN}"
+KINDS = ("text", "media", "matrix-text", "matrix-media")
+DIRECTIONS = {
+    "twilio->matrix": ("text", "media"),
+    "matrix->twilio": ("matrix-text", "matrix-media"),
+    "status": ("status",),
+}
+TOKEN_REGEX = re.compile(r"loadtest(\d{12})")
+
+
+def token_str(token: int) -> str:
+    return f"loadtest{token:012d}"
+
+
+def find_token(text: str) -> Optional[int]:
+    match = TOKEN_REGEX.search(text or "")
+    return int(match.group(1)) if match else None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"unknown message kind {kind!r}, "
+                                             f"expected one of {', '.join(KINDS)}")
+        try:
+            weights[kind] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid weight for {kind}: {weight!r}")
+    if sum(weights.values()) <= 0:
+        raise argparse.ArgumentTypeError("at least one weight must be positive")
+    return weights
+
+
+def parse_override(override: str) -> Tuple[str, Any]:
+    key, sep, value = override.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected KEY=VALUE, got {override!r}")
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+class Tracker:
+    """Matches messages that come out of the bridge to the requests that caused them."""
+    bot_mxid: str
+    started: Dict[int, Tuple[str, float]]
+    status_started: Dict[Tuple[int, str], float]
+    latencies: Dict[str, List[float]]
+    sent: Counter
+    errors: Counter
+    first_sent: Dict[str, float]
+    last_done: Dict[str, float]
+    rooms: Dict[int, str]
+
+    def __init__(self, bot_mxid: str) -> None:
+        self.bot_mxid = bot_mxid
+        self.reset()
+
+    def reset(self) -> None:
+        self.started = {}
+        self.status_started = {}
+        self.latencies = defaultdict(list)
+        self.sent = Counter()
+        self.errors = Counter()
+        self.first_sent = {}
+        self.last_done = {}
+        self.rooms = {}
+
+    def start(self, token: int, kind: str) -> None:
+        now = time.perf_counter()
+        self.started[token] = kind, now
+        self.sent[kind] += 1
+        self.first_sent.setdefault(kind, now)
+
+    def _done(self, kind: str, start: float) -> None:
+        now = time.perf_counter()
+        self.latencies[kind].append(now - start)
+        self.last_done[kind] = now
+
+    def fail(self, token: int) -> None:
+        kind, _ = self.started.pop(token, (None, 0))
+        if kind:
+            self.errors[kind] += 1
+
+    def on_homeserver_message(self, room_id: str, content: Dict[str, Any]) -> None:
+        token = find_token(content.get("body"))
+        if token is None:
+            return
+        self.rooms[token] = room_id
+        try:
+            kind, start = self.started.pop(token)
+        except KeyError:
+            return
+        self._done(kind, start)
+
+    def on_twilio_message(self, text: str) -> None:
+        token = find_token(text)
+        try:
+            kind, start = self.started.pop(token)
+        except KeyError:
+            return
+        self._done(kind, start)
+
+    def on_twilio_status(self, text: str, status: str) -> None:
+        token = find_token(text)
+        if token is not None and status in ("delivered", "read"):
+            now = time.perf_counter()
+            self.status_started[(token, status)] = now
+            self.sent["status"] += 1
+            self.first_sent.setdefault("status", now)
+
+    def on_receipt(self, user_id: str, event_id: str) -> None:
+        token = find_token(event_id)
+        status = "delivered" if user_id == self.bot_mxid else "read"
+        try:
+            start = self.status_started.pop((token, status))
+        except KeyError:
+            return
+        self._done("status", start)
+
+    async def wait(self, timeout: float) -> None:
+        deadline = time.perf_counter() + timeout
+        while self.started and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+
+    def report(self, kinds: Tuple[str, ...]) -> Dict[str, Any]:
+        latencies = [latency for kind in kinds for latency in self.latencies[kind]]
+        sent = sum(self.sent[kind] for kind in kinds)
+        first = min((self.first_sent[kind] for kind in kinds if kind in self.first_sent),
+                    default=None)
+        last = max((self.last_done[kind] for kind in kinds if kind in self.last_done),
+                   default=None)
+        elapsed = last - first if first is not None and last is not None else 0
+        return {
+            "sent": sent,
+            "completed": len(latencies),
+            "errors": sum(self.errors[kind] for kind in kinds),
+            "throughput": len(latencies) / elapsed if elapsed > 0 else 0,
+            "p50_ms": (percentile(latencies, 50) or 0) * 1000,
+            "p99_ms": (percentile(latencies, 99) or 0) * 1000,
+            "max_ms": max(latencies, default=0) * 1000,
+        }
+
+
+class LoadTest:
+    args: argparse.Namespace
+    loop: asyncio.AbstractEventLoop
+    tmpdir: str
+    config: Config
+    tracker: Tracker
+    http: Optional[ClientSession]
+    bridge: Optional[subprocess.Popen]
+
+    homeserver: FakeHomeserver
+    twilio: FakeTwilio
+    hs_url: str
+    twilio_url: str
+    bridge_url: str
+    webhook_url: str
+
+    conversations: List[str]
+    rooms: List[str]
+    offered_rate: float
+    _next_token: int
+
+    def __init__(self, args: argparse.Namespace, tmpdir: str,
+                 loop: asyncio.AbstractEventLoop) -> None:
+        self.args = args
+        self.tmpdir = tmpdir
+        self.loop = loop
+        self.http = None
+        self.bridge = None
+        self._next_token = 0
+        self.rooms = []
+        self.offered_rate = 0
+        self.conversations = [f"whatsapp:+1555{i:07d}" for i in range(args.conversations)]
+        self.hs_url = f"http://127.0.0.1:{free_port()}"
+        self.twilio_url = f"http://127.0.0.1:{free_port()}"
+        bridge_port = free_port()
+        self.bridge_url = f"http://127.0.0.1:{bridge_port}"
+        self.config = self._make_config(bridge_port)
+        self.webhook_url = f"{self.bridge_url}{self.config['twilio.webhook_path']}"
+        bot_localpart = self.config["appservice.bot_username"]
+        self.tracker = Tracker(f"@{bot_localpart}:{DOMAIN}")
+        self.homeserver = FakeHomeserver(DOMAIN, bot_localpart, delay=args.homeserver_delay,
+                                         loop=loop)
+        self.homeserver.on_message = self.tracker.on_homeserver_message
+        self.homeserver.on_receipt = self.tracker.on_receipt
+        self.twilio = FakeTwilio(self.config["twilio.account_id"], self.config["twilio.secret"],
+                                 self.config["twilio.sender_id"], f"{self.webhook_url}/status",
+                                 statuses=[status for status in args.statuses.split(",")
+                                           if status],
+                                 status_delay=args.status_delay, delay=args.twilio_delay,
+                                 media_size=args.media_size, loop=loop)
+        self.twilio.on_message = self.tracker.on_twilio_message
+        self.twilio.on_status = self.tracker.on_twilio_status
+
+    def _make_config(self, bridge_port: int) -> Config:
+        path = os.path.join(self.tmpdir, "config.yaml")
+        shutil.copyfile("example-config.yaml", path)
+        config = Config(path, os.path.join(self.tmpdir, "registration.yaml"),
+                        "example-config.yaml")
+        config.load()
+        config["homeserver.address"] = self.hs_url
+        config["homeserver.public_address"] = self.hs_url
+        config["homeserver.domain"] = DOMAIN
+        config["appservice.address"] = self.bridge_url
+        config["appservice.hostname"] = "127.0.0.1"
+        config["appservice.port"] = bridge_port
+        config["appservice.database"] = (self.args.database or
+                                         f"sqlite:///{os.path.join(self.tmpdir, 'bridge.db')}")
+        config["bridge.permissions"] = {DOMAIN: "user"}
+        config["twilio.api_url"] = f"{self.twilio_url}/2010-04-01"
+        config["twilio.rate_limit.messages_per_second"] = 10000
+        config["twilio.rate_limit.burst"] = 10000
+        config["logging"] = {
+            "version": 1,
+            # The bridge's loggers are created on import, before the logging config is applied
+            "disable_existing_loggers": False,
+            "formatters": {"normal": {"format": "[%(asctime)s] [%(levelname)s@%(name)s] "
+                                                "%(message)s"}},
+            "handlers": {"file": {"class": "logging.FileHandler", "formatter": "normal",
+                                  "filename": os.path.join(self.tmpdir, "bridge.log")}},
+            "root": {"level": self.args.log_level, "handlers": ["file"]},
+        }
+        for key, value in self.args.set:
+            config[key] = value
+        config.generate_registration()
+        config.save()
+        return config
+
+    def _next(self) -> int:
+        self._next_token += 1
+        return self._next_token
+
+    async def start(self) -> None:
+        for app, url in ((self.homeserver.app, self.hs_url), (self.twilio.app, self.twilio_url)):
+            runner = web.AppRunner(app)
+            await runner.setup()
+            host, port = url[len("http://"):].split(":")
+            await web.TCPSite(runner, host, int(port)).start()
+            app["runner"] = runner
+        self.http = ClientSession(loop=self.loop,
+                                  connector=TCPConnector(limit=self.args.connections))
+        # Older alembic versions have no __main__ module, so call the command line entry point
+        subprocess.run([sys.executable, "-c", "import alembic.config; alembic.config.main()",
+                        "-x", f"config={self.config.path}", "upgrade", "head"],
+                       check=True, stdout=subprocess.DEVNULL)
+        self.bridge = subprocess.Popen([sys.executable, "-m", "mautrix_twilio",
+                                        "-c", self.config.path,
+                                        "-r", self.config.registration_path])
+        deadline = time.perf_counter() + 60
+        while True:
+            if self.bridge.poll() is not None:
+                raise RuntimeError(f"Bridge exited with status {self.bridge.returncode}, "
+                                   f"see {os.path.join(self.tmpdir, 'bridge.log')}")
+            try:
+                async with self.http.get(f"{self.bridge_url}/_matrix/mau/ready") as resp:
+                    if resp.status == 200:
+                        return
+            except ClientError:
+                pass
+            if time.perf_counter() > deadline:
+                raise RuntimeError("Bridge didn't become ready in 60 seconds")
+            await asyncio.sleep(0.2)
+
+    async def stop(self) -> Dict[str, Any]:
+        usage = None
+        if self.bridge and self.bridge.poll() is None:
+            self.bridge.send_signal(signal.SIGTERM)
+            wait = self.loop.run_in_executor(None, os.wait4, self.bridge.pid, 0)
+            try:
+                _, status, usage = await asyncio.wait_for(asyncio.shield(wait), 30)
+            except asyncio.TimeoutError:
+                self.bridge.kill()
+                _, status, usage = await wait
+            # The process was reaped with wait4, so Popen doesn't know the exit status
+            self.bridge.returncode = (os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                                      else -os.WTERMSIG(status))
+        if self.http:
+            await self.http.close()
+        for app in (self.homeserver.app, self.twilio.app):
+            if "runner" in app:
+                await app["runner"].cleanup()
+        if not usage:
+            return {}
+        # ru_maxrss is in kibibytes on Linux, but in bytes on macOS
+        peak_rss = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        return {
+            "peak_rss_mib": peak_rss / 1024 ** 2,
+            "cpu_seconds": usage.ru_utime + usage.ru_stime,
+        }
+
+    async def send_webhook(self, token: int, kind: str, sender: str) -> None:
+        sid = f"SM{token_str(token)}{'0' * 12}"
+        params = {
+            "MessageSid": sid,
+            "SmsMessageSid": sid,
+            "SmsSid": sid,
+            "AccountSid": self.config["twilio.account_id"],
+            "From": sender,
+            "To": self.config["twilio.sender_id"],
+            "SmsStatus": "received",
+            "NumSegments": "1",
+            "ApiVersion": "2010-04-01",
+        }
+        if kind == "media":
+            params.update(Body="", NumMedia="1", MediaContentType0="image/jpeg",
+                          MediaUrl0=f"{self.twilio_url}/media/{token_str(token)}")
+        else:
+            params.update(Body=f"Load test message {token_str(token)}", NumMedia="0")
+        self.tracker.start(token, kind)
+        try:
+            status = await post_signed(self.http, self.config["twilio.secret"],
+                                       f"{self.webhook_url}/receive", params)
+        except (ClientError, OSError):
+            status = None
+        if status is None or status >= 400:
+            self.tracker.fail(token)
+
+    async def send_transaction(self, token: int, kind: str, room_id: str) -> None:
+        if kind == "matrix-media":
+            content = {"msgtype": "m.image", "body": "image.jpg",
+                       "url": f"mxc://{DOMAIN}/{token_str(token)}",
+                       "info": {"mimetype": "image/jpeg", "size": self.args.media_size}}
+        else:
+            content = {"msgtype": "m.text", "body": f"Load test reply {token_str(token)}"}
+        event = {
+            "type": "m.room.message",
+            "room_id": room_id,
+            "sender": SENDER,
+            "event_id": f"${token_str(token)}:{DOMAIN}",
+            "origin_server_ts": int(time.time() * 1000),
+            "content": content,
+            "unsigned": {"age": 0},
+        }
+        url = f"{self.bridge_url}/_matrix/app/v1/transactions/{token_str(token)}"
+        self.tracker.start(token, kind)
+        try:
+            async with self.http.put(url, json={"events": [event]},
+                                     params={"access_token": self.config["appservice.hs_token"]}
+                                     ) as resp:
+                await resp.read()
+                status = resp.status
+        except (ClientError, OSError):
+            status = None
+        if status is None or status >= 400:
+            self.tracker.fail(token)
+
+    async def warm_up(self) -> None:
+        tokens = {self._next(): twid for twid in self.conversations}
+        await asyncio.gather(*(self.send_webhook(token, "text", twid)
+                               for token, twid in tokens.items()))
+        await self.tracker.wait(self.args.drain)
+        self.rooms = [self.tracker.rooms[token] for token in tokens if token in self.tracker.rooms]
+        if len(self.rooms) < len(tokens):
+            raise RuntimeError(f"Only {len(self.rooms)} out of {len(tokens)} portals were "
+                               "created during warm-up")
+        self.tracker.reset()
+
+    async def run(self) -> None:
+        rand = random.Random(self.args.seed)
+        kinds, weights = zip(*self.args.mix.items())
+        tasks = []
+        start = time.perf_counter()
+        total = int(self.args.rate * self.args.duration)
+        for i in range(total):
+            delay = start + i / self.args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            kind, = rand.choices(kinds, weights)
+            index = rand.randrange(len(self.conversations))
+            if kind.startswith("matrix-"):
+                job = self.send_transaction(self._next(), kind, self.rooms[index])
+            else:
+                job = self.send_webhook(self._next(), kind, self.conversations[index])
+            tasks.append(self.loop.create_task(job))
+        offered = total / (time.perf_counter() - start)
+        await asyncio.gather(*tasks)
+        await self.tracker.wait(self.args.drain)
+        # Give the last status callbacks time to arrive
+        await asyncio.sleep(self.twilio.status_delay * len(self.twilio.statuses)
+                            + self.config["twilio.status.coalesce_window"] + 0.5)
+        self.offered_rate = offered
+
+
+def print_results(results: Dict[str, Dict[str, Any]]) -> None:
+    print(f"\n{'':<16} {'sent':>8} {'done':>8} {'errors':>7} {'msg/s':>9} {'p50':>10} "
+          f"{'p99':>10} {'max':>10}")
+    for name, result in results.items():
+        print(f"{name:<16} {result['sent']:>8} {result['completed']:>8} {result['errors']:>7} "
+              f"{result['throughput']:>9.1f} {result['p50_ms']:>8.1f}ms "
+              f"{result['p99_ms']:>8.1f}ms {result['max_ms']:>8.1f}ms")
+
+
+async def run(args: argparse.Namespace, tmpdir: str, loop: asyncio.AbstractEventLoop
+              ) -> Dict[str, Any]:
+    test = LoadTest(args, tmpdir, loop)
+    bridge = {}
+    try:
+        await test.start()
+        print(f"Bridge started, creating {len(test.conversations)} portals")
+        await test.warm_up()
+        print(f"Sending {args.rate} messages per second for {args.duration} seconds")
+        await test.run()
+    finally:
+        bridge = await test.stop()
+    results = {name: test.tracker.report(kinds) for name, kinds in DIRECTIONS.items()}
+    results.update((kind, test.tracker.report((kind,))) for kind in KINDS if kind in args.mix)
+    print_results(results)
+    print(f"\nOffered rate: {test.offered_rate:.1f} msg/s")
+    if test.twilio.status_errors:
+        print(f"Status callbacks rejected by the bridge: {test.twilio.status_errors}")
+    if bridge:
+        print(f"Bridge peak RSS: {bridge['peak_rss_mib']:.1f} MiB, "
+              f"CPU time: {bridge['cpu_seconds']:.1f} s")
+    return {
+        "meta": {
+            "commit": get_commit(),
+            "timestamp": int(time.time()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "rate": args.rate,
+            "offered_rate": test.offered_rate,
+            "duration": args.duration,
+            "conversations": args.conversations,
+            "mix": args.mix,
+            "overrides": dict(args.set),
+        },
+        "results": results,
+        "bridge": bridge,
+        "homeserver_requests": test.homeserver.requests,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run an end-to-end load test of the bridge "
+                                                 "against a fake Twilio API and homeserver.")
+    parser.add_argument("--rate", type=float, default=50, help="messages per second to send")
+    parser.add_argument("--duration", type=float, default=30,
+                        help="number of seconds to send messages for")
+    parser.add_argument("--mix", type=parse_mix, default="text=6,media=1,matrix-text=3",
+                        help="relative weights of each kind of message: text and media "
+                             "webhooks from Twilio, matrix-text and matrix-media transactions "
+                             "(default: text=6,media=1,matrix-text=3)")
+    parser.add_argument("--conversations", type=int, default=100,
+                        help="number of WhatsApp users sending and receiving messages")
+    parser.add_argument("--statuses", default="sent,delivered,read",
+                        help="status callbacks to send for each message sent to Twilio")
+    parser.add_argument("--status-delay", type=float, default=0.1,
+                        help="seconds between the status callbacks of a message")
+    parser.add_argument("--media-size", type=int, default=64 * 1024,
+                        help="size of media files in bytes")
+    parser.add_argument("--twilio-delay", type=float, default=0,
+                        help="seconds the fake Twilio API takes to respond")
+    parser.add_argument("--homeserver-delay", type=float, default=0,
+                        help="seconds the fake homeserver takes to respond")
+    parser.add_argument("--connections", type=int, default=100,
+                        help="maximum number of concurrent requests to the bridge")
+    parser.add_argument("--drain", type=float, default=30,
+                        help="seconds to wait for outstanding messages after sending")
+    parser.add_argument("--database", help="database URL for the bridge (default: temporary "
+                                           "SQLite database)")
+    parser.add_argument("--set", type=parse_override, action="append", default=[],
+                        metavar="KEY=VALUE", help="override a bridge config option, the value "
+                                                  "is parsed as JSON if possible")
+    parser.add_argument("--log-level", default="WARNING", help="log level of the bridge")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the message mix")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the temporary directory with the bridge config and log")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    tmpdir = tempfile.mkdtemp(prefix="mautrix-twilio-loadtest-")
+    try:
+        output = loop.run_until_complete(run(args, tmpdir, loop))
+    finally:
+        if args.keep:
+            print(f"Bridge config and log are in {tmpdir}")
+        else:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
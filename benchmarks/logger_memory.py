@@ -0,0 +1,49 @@
+"""
+Measures the memory retained by per-entity loggers after the entities are gone.
+
+Usage: python -m benchmarks.logger_memory [count]
+"""
+import logging
+import sys
+import gc
+import tracemalloc
+
+from mautrix_twilio.util.log import EntityLogger
+
+
+class Entity:
+    log: logging.Logger = logging.getLogger("mau.portal")
+
+    def __init__(self, twid: str, adapter: bool) -> None:
+        self.twid = twid
+        if adapter:
+            self.log = EntityLogger(self.log, twid)
+        else:
+            self.log = self.log.getChild(twid)
+
+
+def measure(count: int, adapter: bool) -> int:
+    gc.collect()
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    for i in range(count):
+        entity = Entity(f"whatsapp:+1555{i:07d}", adapter)
+        entity.log.debug("Handling message")
+    del entity
+    gc.collect()
+    end, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return end - start
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    adapter = measure(count, adapter=True)
+    child = measure(count, adapter=False)
+    print(f"{count} distinct entities")
+    print(f"EntityLogger:    {adapter / 1024:10.1f} KiB retained")
+    print(f"Logger.getChild: {child / 1024:10.1f} KiB retained")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Compares rendering outgoing messages through MessageTemplate with substituting the values into
+the HTML template and parsing the result for every message.
+
+Usage: python -m benchmarks.matrix_formatter [iterations]
+"""
+from typing import Callable
+from string import Template
+from html import escape
+import timeit
+import sys
+
+from mautrix_twilio.formatter.from_matrix import matrix_to_whatsapp, MessageTemplate
+
+TEMPLATE = "$message<br/>- $displayname"
+VALUES = {"mxid": "@alice:example.com", "localpart": "alice", "displayname": "Alice"}
+
+PLAIN_MESSAGES = {
+    "short plain": "Hi, your order has been shipped.",
+    "long plain": "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 40,
+}
+HTML_MESSAGES = {
+    "short html": "Your code is <strong>123456</strong>",
+    "long html": "<p>Some <em>formatted</em> text with a <a href='https://example.com'>link</a>"
+                 "</p>" * 20,
+}
+
+
+def bench(func: Callable[[], str], iterations: int) -> float:
+    return min(timeit.repeat(func, number=iterations, repeat=3)) / iterations
+
+
+def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    html_template = Template(TEMPLATE)
+    # The HTML messages stay in the cache, like repeated notifications would
+    cached = MessageTemplate(TEMPLATE)
+    uncached = MessageTemplate(TEMPLATE, cache_size=0)
+
+    print(f"{'message':<14} {'full parse':>12} {'template':>12} {'cached':>12}")
+    for name, text in PLAIN_MESSAGES.items():
+        full = bench(lambda: matrix_to_whatsapp(
+            html_template.safe_substitute(message=escape(text), **VALUES)), iterations)
+        fast = bench(lambda: cached.render_text(text, **VALUES), iterations)
+        print(f"{name:<14} {full * 1e6:>10.1f}µs {fast * 1e6:>10.1f}µs {'-':>12}")
+    for name, html in HTML_MESSAGES.items():
+        full = bench(lambda: matrix_to_whatsapp(
+            html_template.safe_substitute(message=html, **VALUES)), iterations)
+        fast = bench(lambda: uncached.render_html(html, **VALUES), iterations)
+        warm = bench(lambda: cached.render_html(html, **VALUES), iterations)
+        print(f"{name:<14} {full * 1e6:>10.1f}µs {fast * 1e6:>10.1f}µs {warm * 1e6:>10.1f}µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""
+Micro-benchmarks for the functions on the per-message path. Everything runs offline, the
+database benchmarks use a temporary SQLite database. Run from the repository root, since the
+configuration is loaded from example-config.yaml.
+
+Results are written as JSON, so that runs from different commits can be compared:
+
+    python -m benchmarks.suite --output before.json
+    (check out another commit)
+    python -m benchmarks.suite --output after.json --compare before.json
+
+Usage: python -m benchmarks.suite [--output FILE] [--compare FILE] [--threshold PERCENT]
+                                  [--filter SUBSTRING] [--min-time SECONDS]
+"""
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+from hashlib import sha1
+import subprocess
+import statistics
+import argparse
+import platform
+import tempfile
+import asyncio
+import base64
+import hmac
+import json
+import time
+import sys
+import os
+
+from sqlalchemy import create_engine
+from yarl import URL
+
+from mautrix.util.db import Base
+from mautrix.util.simple_template import SimpleTemplate
+
+from mautrix_twilio.config import Config
+from mautrix_twilio.formatter import whatsapp_to_matrix, matrix_to_whatsapp, MessageTemplate
+from mautrix_twilio.twilio.data import TwilioMessageEvent, TwilioStatusEvent
+from mautrix_twilio.twilio.request_validator import RequestValidator
+from mautrix_twilio.twilio.webhook import TwilioHandler
+from mautrix_twilio.puppet import Puppet
+from mautrix_twilio.util import LRUCache
+from mautrix_twilio import db
+
+from . import corpus
+
+Case = Tuple[str, Callable[[], Any]]
+AsyncCase = Tuple[str, Callable[[], Awaitable[Any]]]
+
+REPEATS = 5
+
+
+def formatter_cases() -> Iterator[Case]:
+    for name, text in corpus.WHATSAPP_TEXTS.items():
+        yield f"formatter.whatsapp_to_matrix.{name}", lambda text=text: whatsapp_to_matrix(text)
+    for name, html in corpus.MATRIX_HTML.items():
+        yield f"formatter.matrix_to_whatsapp.{name}", lambda html=html: matrix_to_whatsapp(html)
+    template = MessageTemplate("$message<br/>- $displayname")
+    yield ("formatter.message_template.render_text",
+           lambda: template.render_text(corpus.SHORT_PLAIN, displayname="Alice"))
+
+
+def webhook_cases() -> Iterator[Case]:
+    url = URL(corpus.WEBHOOK_URL)
+    signing_data = corpus.WEBHOOK_URL + "".join(key + value for key, value
+                                                in sorted(corpus.MESSAGE_WEBHOOK.items()))
+    signature = base64.b64encode(hmac.new(corpus.WEBHOOK_TOKEN.encode("utf-8"),
+                                          signing_data.encode("utf-8"), sha1).digest()
+                                 ).decode("utf-8")
+    validator = RequestValidator(corpus.WEBHOOK_TOKEN)
+    params = TwilioHandler._parse_form(corpus.MESSAGE_WEBHOOK_BODY)
+    assert validator.validate(url, params, signature)
+    yield ("webhook.parse_form",
+           lambda: TwilioHandler._parse_form(corpus.MESSAGE_WEBHOOK_BODY))
+    yield "webhook.validate", lambda: validator.validate(url, params, signature)
+    yield ("webhook.deserialize_message",
+           lambda: TwilioMessageEvent.deserialize(corpus.MESSAGE_WEBHOOK))
+    yield ("webhook.deserialize_status",
+           lambda: TwilioStatusEvent.deserialize(corpus.STATUS_WEBHOOK))
+
+
+def puppet_cases(config: Config) -> Iterator[Case]:
+    Puppet.mxid_template = SimpleTemplate(config["bridge.username_template"], "userid",
+                                          prefix="@", suffix=f":{config['homeserver.domain']}",
+                                          type=str)
+    twid = corpus.MESSAGE_WEBHOOK["From"]
+    mxid = Puppet.get_mxid_from_twid(twid)
+    yield "puppet.get_mxid_from_twid", lambda: Puppet.get_mxid_from_twid(twid)
+
+    def get_twid(cache: LRUCache, user_id: str) -> Callable[[], Any]:
+        def func() -> Any:
+            Puppet.twid_by_mxid = cache
+            return Puppet.get_twid_from_mxid(user_id)
+        return func
+
+    yield "puppet.get_twid_from_mxid.cached", get_twid(LRUCache(1024), mxid)
+    yield "puppet.get_twid_from_mxid.uncached", get_twid(LRUCache(0), mxid)
+    yield ("puppet.get_twid_from_mxid.not_puppet",
+           get_twid(LRUCache(0), "@alice:example.com"))
+
+
+def config_cases(config: Config) -> Iterator[Case]:
+    config["bridge.permissions"] = {
+        "*": "relaybot",
+        "example.com": "user",
+        "@admin:example.com": "admin",
+        **{f"@user{i}:example.org": "user" for i in range(100)},
+    }
+    yield "config.get_permissions.user", lambda: config.get_permissions("@admin:example.com")
+    yield "config.get_permissions.domain", lambda: config.get_permissions("@bob:example.com")
+    yield "config.get_permissions.wildcard", lambda: config.get_permissions("@eve:evil.com")
+
+
+def db_cases(path: str, loop: asyncio.AbstractEventLoop, portals: int = 1000,
+             messages_per_portal: int = 50) -> Iterator[AsyncCase]:
+    engine = create_engine(f"sqlite:///{path}")
+    db.init(engine, loop, threads=1)
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(db.Portal.t.insert(), [dict(twid=f"whatsapp:+1555{i:07d}",
+                                                 mxid=f"!room{i}:example.com")
+                                            for i in range(portals)])
+        conn.execute(db.Puppet.t.insert(), [dict(twid=f"whatsapp:+1555{i:07d}",
+                                                 matrix_registered=True,
+                                                 displayname=f"+1 555 {i:07d} (WhatsApp)")
+                                            for i in range(portals)])
+        conn.execute(db.Message.t.insert(), [dict(portal_id=portal_id, twid=f"SM{portal_id}x{i}",
+                                                  mxid=f"$event{portal_id}x{i}")
+                                             for portal_id in range(1, portals + 1)
+                                             for i in range(messages_per_portal)])
+    portal_id = portals // 2
+    twid = f"whatsapp:+1555{portal_id:07d}"
+    yield "db.portal.get_by_twid", lambda: db.Portal.get_by_twid(twid)
+    yield "db.portal.get_by_mxid", lambda: db.Portal.get_by_mxid(f"!room{portal_id}:example.com")
+    yield "db.puppet.get_by_twid", lambda: db.Puppet.get_by_twid(twid)
+    yield ("db.message.get_by_twid",
+           lambda: db.Message.get_by_twid(f"SM{portal_id}x10", portal_id))
+    yield ("db.message.get_by_mxid",
+           lambda: db.Message.get_by_mxid(f"$event{portal_id}x10", portal_id))
+    yield ("db.message.get_by_twid.missing",
+           lambda: db.Message.get_by_twid("SMmissing", portal_id))
+
+
+def measure(run: Callable[[int], float], min_time: float) -> Dict[str, Any]:
+    iterations = 1
+    while True:
+        duration = run(iterations)
+        if duration >= min_time / REPEATS:
+            break
+        iterations *= 2 if duration <= 0 else max(2, int(min_time / REPEATS / duration) + 1)
+    timings = [duration] + [run(iterations) for _ in range(REPEATS - 1)]
+    per_op = [timing / iterations * 1e9 for timing in timings]
+    return {
+        "iterations": iterations,
+        "repeats": REPEATS,
+        "median_ns": statistics.median(per_op),
+        "min_ns": min(per_op),
+        "ops_per_sec": 1e9 / statistics.median(per_op),
+    }
+
+
+def run_sync(func: Callable[[], Any]) -> Callable[[int], float]:
+    def run(iterations: int) -> float:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        return time.perf_counter() - start
+    return run
+
+
+def run_async(func: Callable[[], Awaitable[Any]], loop: asyncio.AbstractEventLoop
+              ) -> Callable[[int], float]:
+    async def repeat(iterations: int) -> float:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            await func()
+        return time.perf_counter() - start
+
+    return lambda iterations: loop.run_until_complete(repeat(iterations))
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: Dict[str, Dict[str, Any]], previous: Dict[str, Dict[str, Any]],
+            threshold: float) -> List[str]:
+    regressions = []
+    print(f"\n{'benchmark':<45} {'before':>12} {'after':>12} {'change':>8}")
+    for name, result in results.items():
+        if name not in previous:
+            continue
+        before, after = previous[name]["median_ns"], result["median_ns"]
+        change = (after - before) / before * 100
+        marker = ""
+        if change > threshold:
+            regressions.append(name)
+            marker = " !"
+        print(f"{name:<45} {before:>10.0f}ns {after:>10.0f}ns {change:>+7.1f}%{marker}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the mautrix-twilio micro-benchmarks.")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=10,
+                        help="percentage slowdown that counts as a regression (default: 10)")
+    parser.add_argument("--filter", default="", help="only run benchmarks containing this")
+    parser.add_argument("--min-time", type=float, default=1,
+                        help="approximate number of seconds to spend on each benchmark")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    config = Config("example-config.yaml", "registration.yaml", "example-config.yaml")
+    config.load()
+
+    results: Dict[str, Dict[str, Any]] = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cases = [(name, run_sync(func)) for name, func in (*formatter_cases(), *webhook_cases(),
+                                                           *puppet_cases(config),
+                                                           *config_cases(config))]
+        cases += [(name, run_async(func, loop)) for name, func
+                  in db_cases(os.path.join(tmpdir, "benchmark.db"), loop)]
+        for name, run in cases:
+            if args.filter not in name:
+                continue
+            results[name] = measure(run, args.min_time)
+            print(f"{name:<45} {results[name]['median_ns']:>12.0f}ns/op "
+                  f"{results[name]['ops_per_sec']:>12.0f} ops/s")
+
+    output = {
+        "meta": {
+            "commit": get_commit(),
+            "timestamp": int(time.time()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file)["results"], args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmarks regressed by more than {args.threshold}%")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
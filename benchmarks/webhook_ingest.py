@@ -0,0 +1,115 @@
+"""
+Measures how many Twilio webhook requests per second a single core can validate and decode,
+comparing the current ingestion path with the previous one (aiohttp's form parsing copied into a
+dict, a concatenated signing string and SerializableAttrs decoding).
+
+Usage: python -m benchmarks.webhook_ingest [iterations]
+"""
+from typing import Callable, Dict
+from urllib.parse import urlencode, parse_qsl
+from hashlib import sha1
+import timeit
+import base64
+import hmac
+import sys
+
+import attr
+from attr import dataclass
+from multidict import MultiDict
+from yarl import URL
+
+from mautrix.types import SerializableAttrs
+
+from mautrix_twilio.twilio.data import (TwilioMessageEvent, TwilioMessageStatus, TwilioMessageID,
+                                        TwilioUserID, TwilioMedia)
+from mautrix_twilio.twilio.request_validator import RequestValidator
+from mautrix_twilio.twilio.webhook import TwilioHandler
+
+TOKEN = "0123456789abcdef0123456789abcdef"
+URL_ = URL("https://bridge.example.com/_twilio/receive")
+PARAMS = {
+    "ToCountry": "US", "ToState": "", "SmsMessageSid": "SM" + "a" * 32, "NumMedia": "1",
+    "ToCity": "", "FromZip": "", "SmsSid": "SM" + "a" * 32, "FromState": "",
+    "SmsStatus": "received",
+    "FromCity": "", "Body": "Hello, I have a question about my order " * 3, "FromCountry": "FI",
+    "To": "whatsapp:+15550001234", "ToZip": "", "NumSegments": "1",
+    "MessageSid": "SM" + "a" * 32, "AccountSid": "AC" + "b" * 32,
+    "From": "whatsapp:+358401234567", "ApiVersion": "2010-04-01",
+    "MediaContentType0": "image/jpeg",
+    "MediaUrl0": "https://api.twilio.com/2010-04-01/Accounts/AC/Messages/MM/Media/ME",
+}
+BODY = urlencode(PARAMS).encode("utf-8")
+
+
+@dataclass
+class OldTwilioMessageEvent(SerializableAttrs['OldTwilioMessageEvent']):
+    id: TwilioMessageID = attr.ib(metadata={"json": "MessageSid"})
+    receiver: TwilioUserID = attr.ib(metadata={"json": "To"})
+    sender: TwilioUserID = attr.ib(metadata={"json": "From"})
+    status: TwilioMessageStatus = attr.ib(metadata={"json": "SmsStatus"})
+
+    body: str = attr.ib(metadata={"json": "Body"})
+    segments: str = attr.ib(metadata={"json": "NumSegments"})
+    media: list = attr.ib(factory=list)
+
+    @classmethod
+    def deserialize(cls, data: Dict[str, str]) -> 'OldTwilioMessageEvent':
+        evt = super().deserialize(data)
+        evt.media = [TwilioMedia(mime_type=data[f"MediaContentType{i}"], url=data[f"MediaUrl{i}"])
+                     for i in range(int(data.get("NumMedia") or 0))]
+        return evt
+
+
+def old_compute_signature(token: bytes, url: URL, params: Dict[str, str]) -> bytes:
+    signature_data = str(url)
+    for key, value in sorted(params.items()):
+        signature_data += key + value
+    return hmac.new(token, signature_data.encode("utf-8"), sha1).digest()
+
+
+def sign(params: Dict[str, str]) -> str:
+    digest = old_compute_signature(TOKEN.encode("utf-8"), URL_, params)
+    return base64.b64encode(digest).decode("utf-8")
+
+
+SIGNATURE = sign(PARAMS)
+
+
+def old_ingest() -> OldTwilioMessageEvent:
+    # Roughly what request.post() does for url-encoded bodies
+    data = dict(**MultiDict(parse_qsl(BODY.decode("utf-8"), keep_blank_values=True)))
+    url = URL_.with_scheme("https").with_port(None)
+    expected = old_compute_signature(TOKEN.encode("utf-8"), url, data)
+    assert hmac.compare_digest(expected, base64.b64decode(SIGNATURE))
+    return OldTwilioMessageEvent.deserialize(data)
+
+
+validator = RequestValidator(TOKEN)
+
+
+def new_ingest() -> TwilioMessageEvent:
+    params = TwilioHandler._parse_form(BODY)
+    assert validator.validate(URL_, params, SIGNATURE)
+    data = {}
+    for key, value in params:
+        data.setdefault(key, value)
+    return TwilioMessageEvent.deserialize(data)
+
+
+def bench(func: Callable[[], object], iterations: int) -> float:
+    return iterations / min(timeit.repeat(func, number=iterations, repeat=3))
+
+
+def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    old, new = old_ingest(), new_ingest()
+    assert (old.id, old.sender, old.body, old.media) == (new.id, new.sender, new.body, new.media)
+    old_rate = bench(old_ingest, iterations)
+    new_rate = bench(new_ingest, iterations)
+    print(f"{len(BODY)} byte form body")
+    print(f"previous path: {old_rate:>10.0f} requests/s")
+    print(f"current path:  {new_rate:>10.0f} requests/s ({new_rate / old_rate:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
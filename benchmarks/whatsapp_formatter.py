@@ -0,0 +1,87 @@
+"""
+Compares the WhatsApp to Matrix formatter with the regex implementation it replaced, and checks
+that both produce the same output for randomly generated messages.
+
+The reference implementation uses the bold pattern with a closing ``\\*`` instead of the stray
+``\\\\*`` of the old code, which didn't require a closing asterisk at all.
+
+Usage: python -m benchmarks.whatsapp_formatter [iterations] [equivalence samples]
+"""
+from typing import Callable, List, Match, Optional, Tuple
+import random
+import timeit
+import sys
+import re
+
+from mautrix_twilio.formatter.from_whatsapp import whatsapp_to_matrix
+
+italic = re.compile(r"([\s>~*]|^)_(.+?)_([^a-zA-Z\d]|$)")
+bold = re.compile(r"([\s>_~]|^)\*(.+?)\*([^a-zA-Z\d]|$)")
+strike = re.compile(r"([\s>_*]|^)~(.+?)~([^a-zA-Z\d]|$)")
+code_block = re.compile("```((?:.|\n)+?)```")
+
+
+def code_block_repl(match: Match) -> str:
+    text = match.group(1)
+    if "\n" in text:
+        return f"<pre><code>{text}</code></pre>"
+    return f"<code>{text}</code>"
+
+
+def reference_whatsapp_to_matrix(text: str) -> Tuple[Optional[str], str]:
+    html = italic.sub(r"\1<em>\2</em>\3", text)
+    html = bold.sub(r"\1<strong>\2</strong>\3", html)
+    html = strike.sub(r"\1<del>\2</del>\3", html)
+    html = code_block.sub(code_block_repl, html)
+    if html != text:
+        return html.replace("\n", "<br/>"), text
+    return None, text
+
+
+SAMPLE_ALPHABET = "_*~`\n >aZ9.é<\xa0٣"
+
+MESSAGES = {
+    "short plain": "Hi, is my order on its way?",
+    "short formatted": "Your code is *123456*, it expires in _10 minutes_.",
+    "long plain": "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 80,
+    "long formatted": ("*Forwarded* message with _some_ ~old~ formatting and ```code```\n"
+                       * 40),
+    "long unclosed": "* item with an asterisk but no closing one\n" * 80,
+}
+
+
+def check_equivalence(samples: int, seed: int = 0) -> List[str]:
+    rand = random.Random(seed)
+    mismatches = []
+    for _ in range(samples):
+        text = "".join(rand.choice(SAMPLE_ALPHABET) for _ in range(rand.randint(0, 40)))
+        if whatsapp_to_matrix(text) != reference_whatsapp_to_matrix(text):
+            mismatches.append(text)
+    return mismatches
+
+
+def bench(func: Callable[[str], Tuple[Optional[str], str]], text: str, iterations: int
+          ) -> float:
+    return min(timeit.repeat(lambda: func(text), number=iterations, repeat=3)) / iterations
+
+
+def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    samples = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+
+    mismatches = check_equivalence(samples)
+    print(f"{samples} random messages, {len(mismatches)} differ from the reference")
+    for text in mismatches[:10]:
+        print(f"  {text!r}")
+
+    print(f"{'message':<16} {'reference':>12} {'tokenizer':>12}")
+    for name, text in MESSAGES.items():
+        reference = bench(reference_whatsapp_to_matrix, text, iterations)
+        tokenizer = bench(whatsapp_to_matrix, text, iterations)
+        print(f"{name:<16} {reference * 1e6:>10.1f}µs {tokenizer * 1e6:>10.1f}µs")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
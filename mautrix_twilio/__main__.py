@@ -13,6 +13,8 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Tuple
+
 from mautrix.bridge import Bridge
 
 from .config import Config
@@ -20,10 +22,11 @@ from .twilio import TwilioHandler, TwilioClient
 from .matrix import MatrixHandler
 from .sqlstatestore import SQLStateStore
 from .context import Context
-from .puppet import init as init_puppet
-from .portal import init as init_portal
-from .user import init as init_user
-from .db import init as init_db
+from .puppet import Puppet, init as init_puppet
+from .portal import Portal, init as init_portal
+from .user import User, init as init_user
+from .util import BoundedRegistry
+from .db import init as init_db, Message as DBMessage
 from . import __version__
 
 
@@ -40,8 +43,14 @@ class TwilioBridge(Bridge):
     twilio: TwilioHandler
     twilio_client: TwilioClient
 
+    @property
+    def registries(self) -> Tuple[BoundedRegistry, ...]:
+        return Portal.by_twid, Puppet.by_twid, User.by_mxid
+
     def prepare_bridge(self) -> None:
-        init_db(self.db)
+        init_db(self.db, self.loop, self.config["appservice.database_threads"],
+                batch_size=self.config["appservice.message_batch.size"],
+                batch_delay=self.config["appservice.message_batch.delay"])
         self.twilio_client = TwilioClient(config=self.config, loop=self.loop)
         context = Context(az=self.az, config=self.config, twc=self.twilio_client, loop=self.loop)
         context.mx = self.matrix = MatrixHandler(self.az, self.config, self.loop)
@@ -50,6 +59,24 @@ class TwilioBridge(Bridge):
         init_portal(context)
         init_puppet(context)
         self.az.app.add_subapp(self.config["twilio.webhook_path"], self.twilio.app)
+        self.startup_actions = (self.twilio.start(), Portal.resume_outbox(),
+                                Puppet.start_displayname_sync(),
+                                *(registry.start(self.loop) for registry in self.registries))
+        if Portal.media_cache:
+            self.startup_actions += (Portal.media_cache.start(),)
+        if Portal.room_pool is not None:
+            self.startup_actions += (Portal.room_pool.start(),)
+
+    def prepare_stop(self) -> None:
+        self.shutdown_actions = (self.twilio.stop(), Portal.outbox.stop(),
+                                 self.twilio_client.stop(), Puppet.stop_displayname_sync(),
+                                 *(registry.stop() for registry in self.registries))
+        if Portal.media_cache:
+            self.shutdown_actions += (Portal.media_cache.stop(),)
+        if Portal.room_pool is not None:
+            self.shutdown_actions += (Portal.room_pool.stop(),)
+        if DBMessage.buffer:
+            self.shutdown_actions += (DBMessage.buffer.flush(),)
 
 
 TwilioBridge().run()
@@ -27,15 +27,31 @@ class Config(BaseBridgeConfig):
 
         copy("homeserver.public_address")
 
+        copy("appservice.database_threads")
+        copy("appservice.message_batch.size")
+        copy("appservice.message_batch.delay")
         copy("appservice.community_id")
 
         copy("bridge.username_template")
+        copy("bridge.displayname_sync_concurrency")
         copy("bridge.command_prefix")
 
         copy("bridge.invite_users")
 
+        copy("bridge.max_media_size")
+        copy("bridge.media_concurrency")
+        copy("bridge.media_cache.enabled")
+        copy("bridge.media_cache.max_file_size")
+        copy("bridge.media_cache.memory_size")
+        copy("bridge.media_cache.retention")
+
         copy("bridge.federate_rooms")
         copy("bridge.initial_state")
+        copy("bridge.room_pool.size")
+
+        for registry in ("portal", "puppet", "user"):
+            copy(f"bridge.cache.{registry}.max_size")
+            copy(f"bridge.cache.{registry}.idle_timeout")
 
         copy_dict("bridge.permissions")
 
@@ -43,6 +59,26 @@ class Config(BaseBridgeConfig):
         copy("twilio.sender_id")
         copy("twilio.secret")
         copy("twilio.webhook_path")
+        copy("twilio.api_url")
+        for pool in ("api", "media"):
+            copy(f"twilio.http.{pool}.limit")
+            copy(f"twilio.http.{pool}.limit_per_host")
+            copy(f"twilio.http.{pool}.keepalive_timeout")
+            copy(f"twilio.http.{pool}.dns_cache_ttl")
+            copy(f"twilio.http.{pool}.connect_timeout")
+            copy(f"twilio.http.{pool}.read_timeout")
+        copy("twilio.rate_limit.messages_per_second")
+        copy("twilio.rate_limit.burst")
+        copy("twilio.rate_limit.max_retries")
+        copy("twilio.rate_limit.stats_interval")
+        copy("twilio.status.index_size")
+        copy("twilio.status.wait_timeout")
+        copy("twilio.status.coalesce_window")
+        copy("twilio.async_webhooks")
+        copy("twilio.async_webhook_retries")
+        copy("twilio.dedup_cache_size")
+        copy("twilio.max_concurrent_portals")
+        copy("twilio.portal_worker_idle_timeout")
 
     def _get_permissions(self, key: str) -> Tuple[bool, bool]:
         level = self["bridge.permissions"].get(key, "")
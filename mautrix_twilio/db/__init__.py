@@ -13,17 +13,32 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+
 from sqlalchemy.engine.base import Engine
 
 from mautrix.bridge.db import UserProfile, RoomState
 
+from .executor import init_executor
 from .puppet import Puppet
 from .portal import Portal
-from .message import Message
+from .message import Message, MessageBuffer
+from .inbound_event import InboundEvent
+from .media_cache import MediaCache
+from .outbox import OutboxMessage
+from .room_pool import PooledRoom
+from .bridge_state import BridgeState
 
 
-def init(db_engine: Engine) -> None:
-    for table in (UserProfile, RoomState, Puppet, Portal, Message):
+def init(db_engine: Engine, loop: asyncio.AbstractEventLoop, threads: int,
+         batch_size: int = 1, batch_delay: float = 0) -> None:
+    if db_engine.dialect.name == "sqlite":
+        threads = 1
+    init_executor(loop, threads)
+    if batch_size > 1:
+        Message.buffer = MessageBuffer(batch_size, batch_delay, loop)
+    for table in (UserProfile, RoomState, Puppet, Portal, Message, InboundEvent,
+                  MediaCache, OutboxMessage, PooledRoom, BridgeState):
         table.db = db_engine
         table.t = table.__table__
         table.c = table.t.c
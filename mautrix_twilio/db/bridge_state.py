@@ -0,0 +1,38 @@
+# mautrix-twilio - A Matrix-Twilio relaybot bridge.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Optional
+
+from sqlalchemy import Column, String, Text
+
+from mautrix.util.db import Base
+
+from .executor import AsyncBase, run
+
+
+class BridgeState(AsyncBase, Base):
+    __tablename__ = "bridge_state"
+
+    key: str = Column(String(127), primary_key=True)
+    value: str = Column(Text, nullable=False)
+
+    @classmethod
+    async def get(cls, key: str) -> Optional[str]:
+        state = await run(cls._select_one_or_none, cls.c.key == key)
+        return state.value if state else None
+
+    @classmethod
+    async def set(cls, key: str, value: str) -> None:
+        await run(cls(key=key, value=value).upsert)
@@ -0,0 +1,51 @@
+# mautrix-twilio - A Matrix-Twilio relaybot bridge.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Callable, Optional, TypeVar
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+
+T = TypeVar("T")
+
+_executor: Optional[ThreadPoolExecutor] = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def init_executor(loop: asyncio.AbstractEventLoop, threads: int) -> None:
+    global _executor, _loop
+    _loop = loop
+    _executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="db")
+
+
+async def run(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run a blocking database function in the database thread pool."""
+    return await _loop.run_in_executor(_executor, partial(func, *args, **kwargs))
+
+
+class AsyncBase:
+    """
+    Mixin for :class:`mautrix.util.db.Base` models that makes the write methods awaitable and
+    runs them in the database thread pool instead of blocking the event loop.
+    """
+
+    async def insert(self) -> None:
+        await run(super().insert)
+
+    async def edit(self, **values: Any) -> None:
+        await run(super().edit, **values)
+
+    async def delete(self) -> None:
+        await run(super().delete)
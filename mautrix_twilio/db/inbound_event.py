@@ -0,0 +1,58 @@
+# mautrix-twilio - A Matrix-Twilio relaybot bridge.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, List
+import json
+
+from sqlalchemy import Column, Integer, String, Text
+
+from mautrix.util.db import Base
+
+from .executor import AsyncBase, run
+
+
+class InboundEvent(AsyncBase, Base):
+    __tablename__ = "inbound_event"
+
+    id: int = Column(Integer, primary_key=True, autoincrement=True)
+    type: str = Column(String(31), nullable=False)
+    data: str = Column(Text, nullable=False)
+
+    @property
+    def params(self) -> Dict[str, str]:
+        return json.loads(self.data)
+
+    @classmethod
+    async def create(cls, evt_type: str, params: Dict[str, str]) -> 'InboundEvent':
+        evt = cls(id=None, type=evt_type, data=json.dumps(params))
+        await evt.insert()
+        return evt
+
+    @classmethod
+    def _get_all(cls) -> List['InboundEvent']:
+        rows = cls.db.execute(cls.t.select().order_by(cls.c.id))
+        return [cls.scan(row) for row in rows]
+
+    @classmethod
+    async def all(cls) -> List['InboundEvent']:
+        return await run(cls._get_all)
+
+    def _insert(self) -> None:
+        with self.db.begin() as conn:
+            res = conn.execute(self.t.insert().values(type=self.type, data=self.data))
+            self.id = res.inserted_primary_key[0]
+
+    async def insert(self) -> None:
+        await run(self._insert)
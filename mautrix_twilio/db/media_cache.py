@@ -0,0 +1,64 @@
+# mautrix-twilio - A Matrix-Twilio relaybot bridge.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Optional
+import time
+
+from sqlalchemy import Column, String, Integer, and_
+
+from mautrix.util.db import Base
+from mautrix.types import ContentURI
+
+from .executor import AsyncBase, run
+
+
+class MediaCache(AsyncBase, Base):
+    __tablename__ = "media_cache"
+
+    hash: str = Column(String(64), primary_key=True)
+    mime_type: str = Column(String(127), primary_key=True)
+    size: int = Column(Integer, primary_key=True)
+    mxc: ContentURI = Column(String(255), nullable=False)
+    created_at: int = Column(Integer, nullable=False)
+
+    @classmethod
+    async def get(cls, hash: str, mime_type: str, size: int) -> Optional['MediaCache']:
+        return await run(cls._select_one_or_none, and_(cls.c.hash == hash,
+                                                       cls.c.mime_type == mime_type,
+                                                       cls.c.size == size))
+
+    @classmethod
+    def _delete_older_than(cls, ts: int) -> int:
+        with cls.db.begin() as conn:
+            return conn.execute(cls.t.delete().where(cls.c.created_at < ts)).rowcount
+
+    @classmethod
+    async def delete_older_than(cls, ts: int) -> int:
+        return await run(cls._delete_older_than, ts)
+
+    def _replace_expired(self, expired_before: int) -> None:
+        with self.db.begin() as conn:
+            # An expired entry that hasn't been swept yet would make the insert fail
+            conn.execute(self.t.delete().where(and_(self._edit_identity,
+                                                    self.c.created_at < expired_before)))
+            conn.execute(self.t.insert().values(**self._insert_values))
+
+    @classmethod
+    async def create(cls, hash: str, mime_type: str, size: int, mxc: ContentURI,
+                     expired_before: int = 0) -> 'MediaCache':
+        entry = cls(hash=hash, mime_type=mime_type, size=size, mxc=mxc,
+                    created_at=int(time.time()))
+        await run(entry._replace_expired, expired_before)
+        return entry
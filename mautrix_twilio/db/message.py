@@ -13,35 +13,174 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, Iterable, TYPE_CHECKING
+from typing import Optional, List, Dict, Tuple, TYPE_CHECKING
+import logging
+import asyncio
 
-from sqlalchemy import Column, String, and_
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, and_
+from sqlalchemy.exc import IntegrityError
 
 from mautrix.util.db import Base
-from mautrix.types import RoomID, EventID
+from mautrix.types import EventID
+
+from .executor import AsyncBase, run
 
 if TYPE_CHECKING:
-    from ..twilio import TwilioUserID, TwilioMessageID
+    from ..twilio import TwilioMessageID
+
+MessageKey = Tuple[int, 'TwilioMessageID']
 
 
-class Message(Base):
+class Message(AsyncBase, Base):
     __tablename__ = "message"
 
-    mxid: EventID = Column(String(255))
-    mx_room: RoomID = Column(String(255))
-    tw_receiver: 'TwilioUserID' = Column(String(127), primary_key=True)
+    buffer: Optional['MessageBuffer'] = None
+
+    portal_id: int = Column(Integer, ForeignKey("portal.id", ondelete="CASCADE"),
+                            primary_key=True)
     twid: 'TwilioMessageID' = Column(String(127), primary_key=True)
+    mxid: EventID = Column(String(255))
+
+    __table_args__ = (Index("message_portal_mxid_idx", "portal_id", "mxid"),)
+
+    @classmethod
+    def _bulk_insert(cls, messages: List['Message']) -> None:
+        with cls.db.begin() as conn:
+            conn.execute(cls.t.insert(), [dict(portal_id=msg.portal_id, twid=msg.twid,
+                                               mxid=msg.mxid)
+                                          for msg in messages])
+
+    @classmethod
+    async def bulk_insert(cls, messages: List['Message']) -> None:
+        await run(cls._bulk_insert, messages)
+
+    async def insert_buffered(self) -> None:
+        """Insert the message in the next batch, or immediately if batching is disabled."""
+        if self.buffer:
+            self.buffer.add(self)
+        else:
+            await self.insert()
 
     @classmethod
-    def get_all_by_twid(cls, twid: 'TwilioMessageID', tw_receiver: 'TwilioUserID'
-                        ) -> Iterable['Message']:
-        return cls._select_all(cls.c.twid == twid, cls.c.tw_receiver == tw_receiver)
+    async def get_all_by_twid(cls, twid: 'TwilioMessageID', portal_id: int
+                              ) -> List['Message']:
+        return await run(lambda: list(cls._select_all(cls.c.portal_id == portal_id,
+                                                      cls.c.twid == twid)))
 
     @classmethod
-    def get_by_twid(cls, twid: 'TwilioMessageID', tw_receiver: 'TwilioUserID'
-                    ) -> Optional['Message']:
-        return cls._select_one_or_none(and_(cls.c.twid == twid, cls.c.tw_receiver == tw_receiver))
+    async def get_by_twid(cls, twid: 'TwilioMessageID', portal_id: int) -> Optional['Message']:
+        if cls.buffer:
+            pending = cls.buffer.get_by_twid(twid, portal_id)
+            if pending:
+                return pending
+        return await run(cls._select_one_or_none, and_(cls.c.portal_id == portal_id,
+                                                       cls.c.twid == twid))
 
     @classmethod
-    def get_by_mxid(cls, mxid: EventID, mx_room: RoomID) -> Optional['Message']:
-        return cls._select_one_or_none(and_(cls.c.mxid == mxid, cls.c.mx_room == mx_room))
+    async def get_by_mxid(cls, mxid: EventID, portal_id: int) -> Optional['Message']:
+        if cls.buffer:
+            pending = cls.buffer.get_by_mxid(mxid, portal_id)
+            if pending:
+                return pending
+        return await run(cls._select_one_or_none, and_(cls.c.portal_id == portal_id,
+                                                       cls.c.mxid == mxid))
+
+
+class MessageBuffer:
+    """
+    Collects new message mappings and inserts them in batches. A batch is written when it
+    reaches ``max_size`` rows or ``max_delay`` seconds after its first row was added. Batches
+    that fail because of a database error are queued again with backoff, up to ``max_retries``
+    times.
+    """
+    log: logging.Logger = logging.getLogger("mau.db.message_buffer")
+    loop: asyncio.AbstractEventLoop
+    max_size: int
+    max_delay: float
+    max_retries: int
+
+    _pending: Dict[MessageKey, Message]
+    _flushing: Dict[MessageKey, Message]
+    _attempts: Dict[MessageKey, int]
+    _timer: Optional[asyncio.TimerHandle]
+
+    def __init__(self, max_size: int, max_delay: float, loop: asyncio.AbstractEventLoop,
+                 max_retries: int = 3) -> None:
+        self.loop = loop
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self._pending = {}
+        self._flushing = {}
+        self._attempts = {}
+        self._timer = None
+
+    def add(self, msg: Message) -> None:
+        self._pending[(msg.portal_id, msg.twid)] = msg
+        if len(self._pending) >= self.max_size:
+            self._schedule_flush()
+        elif not self._timer:
+            self._timer = self.loop.call_later(self.max_delay, self._schedule_flush)
+
+    def get_by_twid(self, twid: 'TwilioMessageID', portal_id: int) -> Optional[Message]:
+        key = (portal_id, twid)
+        return self._pending.get(key) or self._flushing.get(key)
+
+    def get_by_mxid(self, mxid: EventID, portal_id: int) -> Optional[Message]:
+        for msg in (*self._pending.values(), *self._flushing.values()):
+            if msg.mxid == mxid and msg.portal_id == portal_id:
+                return msg
+        return None
+
+    def _schedule_flush(self) -> None:
+        self.loop.create_task(self.flush())
+
+    async def flush(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        self._flushing.update(batch)
+        try:
+            await Message.bulk_insert(list(batch.values()))
+        except IntegrityError:
+            self.log.warning(f"Batch insert of {len(batch)} messages failed, "
+                             "inserting them one by one")
+            for msg in batch.values():
+                try:
+                    await msg.insert()
+                except IntegrityError:
+                    self.log.warning(f"Failed to insert {msg.twid} -> {msg.mxid}", exc_info=True)
+                except Exception:
+                    self._requeue({(msg.portal_id, msg.twid): msg})
+        except Exception:
+            self.log.exception(f"Failed to insert batch of {len(batch)} messages")
+            self._requeue(batch)
+        finally:
+            for key in batch:
+                if key not in self._pending:
+                    self._attempts.pop(key, None)
+            for key, msg in batch.items():
+                if self._flushing.get(key) is msg:
+                    del self._flushing[key]
+
+    def _requeue(self, batch: Dict[MessageKey, Message]) -> None:
+        dropped = 0
+        max_attempts = 0
+        for key, msg in batch.items():
+            attempts = self._attempts.get(key, 0) + 1
+            if attempts > self.max_retries:
+                dropped += 1
+                continue
+            self._attempts[key] = attempts
+            max_attempts = max(max_attempts, attempts)
+            # A newer mapping of the same message may have been added while flushing
+            self._pending.setdefault(key, msg)
+        if dropped:
+            self.log.error(f"Dropping {dropped} message mappings after {self.max_retries} "
+                           "failed inserts")
+        if max_attempts and not self._timer:
+            self._timer = self.loop.call_later(self.max_delay * 2 ** max_attempts,
+                                               self._schedule_flush)
@@ -0,0 +1,56 @@
+# mautrix-twilio - A Matrix-Twilio relaybot bridge.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import List, Optional, TYPE_CHECKING
+
+from sqlalchemy import Column, Integer, String, Text
+
+from mautrix.util.db import Base
+from mautrix.types import RoomID, EventID
+
+from .executor import AsyncBase, run
+
+if TYPE_CHECKING:
+    from ..twilio import TwilioUserID
+
+
+class OutboxMessage(AsyncBase, Base):
+    __tablename__ = "outbox"
+
+    id: int = Column(Integer, primary_key=True, autoincrement=True)
+    mxid: EventID = Column(String(255), nullable=False)
+    mx_room: RoomID = Column(String(255), nullable=False)
+    tw_receiver: 'TwilioUserID' = Column(String(127), nullable=False)
+    body: Optional[str] = Column(Text, nullable=True)
+    media: Optional[str] = Column(Text, nullable=True)
+
+    @classmethod
+    def _get_all(cls) -> List['OutboxMessage']:
+        rows = cls.db.execute(cls.t.select().order_by(cls.c.id))
+        return [cls.scan(row) for row in rows]
+
+    @classmethod
+    async def all(cls) -> List['OutboxMessage']:
+        return await run(cls._get_all)
+
+    def _insert(self) -> None:
+        with self.db.begin() as conn:
+            res = conn.execute(self.t.insert().values(mxid=self.mxid, mx_room=self.mx_room,
+                                                      tw_receiver=self.tw_receiver,
+                                                      body=self.body, media=self.media))
+            self.id = res.inserted_primary_key[0]
+
+    async def insert(self) -> None:
+        await run(self._insert)
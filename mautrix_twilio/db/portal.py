@@ -15,25 +15,36 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import Optional, TYPE_CHECKING
 
-from sqlalchemy import Column, String
+from sqlalchemy import Column, Integer, String
 
 from mautrix.util.db import Base
 from mautrix.types import RoomID
 
+from .executor import AsyncBase, run
+
 if TYPE_CHECKING:
     from ..twilio import TwilioUserID
 
 
-class Portal(Base):
+class Portal(AsyncBase, Base):
     __tablename__ = "portal"
 
-    twid: 'TwilioUserID' = Column(String(127), primary_key=True)
-    mxid: RoomID = Column(String(255), nullable=True)
+    id: int = Column(Integer, primary_key=True, autoincrement=True)
+    twid: 'TwilioUserID' = Column(String(127), nullable=False, unique=True)
+    mxid: RoomID = Column(String(255), nullable=True, unique=True)
 
     @classmethod
-    def get_by_twid(cls, twid: 'TwilioUserID') -> Optional['Portal']:
-        return cls._select_one_or_none(cls.c.twid == twid)
+    async def get_by_twid(cls, twid: 'TwilioUserID') -> Optional['Portal']:
+        return await run(cls._select_one_or_none, cls.c.twid == twid)
 
     @classmethod
-    def get_by_mxid(cls, mxid: RoomID) -> Optional['Portal']:
-        return cls._select_one_or_none(cls.c.mxid == mxid)
+    async def get_by_mxid(cls, mxid: RoomID) -> Optional['Portal']:
+        return await run(cls._select_one_or_none, cls.c.mxid == mxid)
+
+    def _insert(self) -> None:
+        with self.db.begin() as conn:
+            res = conn.execute(self.t.insert().values(twid=self.twid, mxid=self.mxid))
+            self.id = res.inserted_primary_key[0]
+
+    async def insert(self) -> None:
+        await run(self._insert)
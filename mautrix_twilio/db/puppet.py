@@ -13,23 +13,56 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, TYPE_CHECKING
+from typing import Optional, List, TYPE_CHECKING
 
 from sqlalchemy import Column, String, Boolean
-from sqlalchemy.sql import expression
+from sqlalchemy.sql import expression, select, and_, or_
 
 from mautrix.util.db import Base
 
+from .executor import AsyncBase, run
+
 if TYPE_CHECKING:
     from ..twilio import TwilioUserID
 
 
-class Puppet(Base):
+class Puppet(AsyncBase, Base):
     __tablename__ = "puppet"
 
     twid: 'TwilioUserID' = Column(String(127), primary_key=True)
     matrix_registered: bool = Column(Boolean, nullable=False, server_default=expression.false())
+    displayname: Optional[str] = Column(String(255), nullable=True)
+
+    @classmethod
+    async def get_by_twid(cls, twid: 'TwilioUserID') -> Optional['Puppet']:
+        return await run(cls._select_one_or_none, cls.c.twid == twid)
+
+    @classmethod
+    def _get_page_with_profile(cls, after: Optional['TwilioUserID'], limit: int
+                               ) -> List['Puppet']:
+        # Puppets registered before displaynames were stored have a profile, but no displayname
+        where = or_(cls.c.displayname.isnot(None), cls.c.matrix_registered)
+        if after is not None:
+            where = and_(cls.c.twid > after, where)
+        rows = cls.db.execute(cls.t.select().where(where).order_by(cls.c.twid).limit(limit))
+        return [cls.scan(row) for row in rows]
+
+    @classmethod
+    async def page_with_profile(cls, after: Optional['TwilioUserID'], limit: int
+                                ) -> List['Puppet']:
+        """Get up to ``limit`` puppets with a profile whose twid sorts after ``after``."""
+        return await run(cls._get_page_with_profile, after, limit)
+
+    # The state store interface is synchronous, so these block like the base state store does
+
+    @classmethod
+    def is_registered(cls, twid: 'TwilioUserID') -> Optional[bool]:
+        row = cls.db.execute(select([cls.c.matrix_registered]).where(cls.c.twid == twid)).first()
+        return row[0] if row else None
 
     @classmethod
-    def get_by_twid(cls, twid: 'TwilioUserID') -> Optional['Puppet']:
-        return cls._select_one_or_none(cls.c.twid == twid)
+    def mark_registered(cls, twid: 'TwilioUserID') -> bool:
+        with cls.db.begin() as conn:
+            res = conn.execute(cls.t.update().where(cls.c.twid == twid)
+                               .values(matrix_registered=True))
+        return res.rowcount > 0
@@ -0,0 +1,37 @@
+# mautrix-twilio - A Matrix-Twilio relaybot bridge.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import List
+
+from sqlalchemy import Column, String
+
+from mautrix.util.db import Base
+from mautrix.types import RoomID
+
+from .executor import AsyncBase, run
+
+
+class PooledRoom(AsyncBase, Base):
+    __tablename__ = "room_pool"
+
+    mxid: RoomID = Column(String(255), primary_key=True)
+
+    @classmethod
+    def _get_all(cls) -> List['PooledRoom']:
+        return [cls.scan(row) for row in cls.db.execute(cls.t.select())]
+
+    @classmethod
+    async def all(cls) -> List['PooledRoom']:
+        return await run(cls._get_all)
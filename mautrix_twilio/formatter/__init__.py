@@ -1,2 +1,2 @@
-from .from_matrix import matrix_to_whatsapp
+from .from_matrix import matrix_to_whatsapp, MessageTemplate
 from .from_whatsapp import whatsapp_to_matrix
@@ -13,15 +13,79 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import cast
+from typing import Any, Dict, List, Optional, cast
+from string import Template
+from html import escape
+import re
 
 from mautrix.util.formatter import (MatrixParser as BaseMatrixParser, MarkdownString, EntityType)
 
+from ..util import LRUCache
+
+html_tag = re.compile(r"<[^>]*>")
+
 
 def matrix_to_whatsapp(html: str) -> str:
     return MatrixParser.parse(html).text
 
 
+def _placeholders(template: Template, text: str) -> List[str]:
+    return sorted(match.group("named") or match.group("braced")
+                  for match in template.pattern.finditer(text)
+                  if match.group("named") or match.group("braced"))
+
+
+class MessageTemplate:
+    """
+    An HTML message template that is rendered into WhatsApp formatting.
+
+    If no placeholder is inside an HTML tag, the template is converted to WhatsApp formatting
+    once, and the values are substituted into the converted template directly. Plain text
+    messages then don't need to be parsed at all, and HTML messages only need their own body
+    converted. The other values are still parsed as HTML like before. Converted bodies and
+    values are kept in separate bounded caches, since the same senders show up all the time.
+    """
+    html_template: Template
+    text_template: Optional[Template]
+
+    _fragments: LRUCache[str, str]
+    _values: LRUCache[str, str]
+
+    def __init__(self, template: str, cache_size: int = 1024, value_cache_size: int = 1024
+                 ) -> None:
+        self.html_template = Template(template)
+        if (_placeholders(self.html_template, template)
+                == _placeholders(self.html_template, html_tag.sub("", template))):
+            self.text_template = Template(matrix_to_whatsapp(template))
+        else:
+            self.text_template = None
+        self._fragments = LRUCache(cache_size)
+        self._values = LRUCache(value_cache_size)
+
+    @staticmethod
+    def _convert(cache: LRUCache[str, str], html: str) -> str:
+        fragment = cache.get(html)
+        if fragment is None:
+            fragment = cache[html] = matrix_to_whatsapp(html)
+        return fragment
+
+    def _substitute(self, message: str, values: Dict[str, Any]) -> str:
+        values = {key: self._convert(self._values, str(value)) for key, value in values.items()}
+        return self.text_template.safe_substitute(message=message, **values).strip()
+
+    def render_text(self, message: str, **values: Any) -> str:
+        if not self.text_template:
+            return matrix_to_whatsapp(self.html_template.safe_substitute(message=escape(message),
+                                                                         **values))
+        return self._substitute(message, values)
+
+    def render_html(self, message: str, **values: Any) -> str:
+        if not self.text_template:
+            return matrix_to_whatsapp(self.html_template.safe_substitute(message=message,
+                                                                         **values))
+        return self._substitute(self._convert(self._fragments, message), values)
+
+
 class WhatsAppFormatString(MarkdownString):
     def format(self, entity_type: EntityType, **kwargs) -> 'WhatsAppFormatString':
         prefix = suffix = ""
@@ -55,4 +119,3 @@ class MatrixParser(BaseMatrixParser[WhatsAppFormatString]):
     @classmethod
     def parse(cls, data: str) -> WhatsAppFormatString:
         return cast(WhatsAppFormatString, super().parse(data))
-
@@ -13,27 +13,118 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Match, Tuple, Optional
+from typing import Dict, List, Optional, Tuple
 import re
 
-italic = re.compile(r"([\s>~*]|^)_(.+?)_([^a-zA-Z\d]|$)")
-bold = re.compile(r"([\s>_~]|^)\*(.+?)\\*([^a-zA-Z\d]|$)")
-strike = re.compile(r"([\s>_*]|^)~(.+?)~([^a-zA-Z\d]|$)")
-code_block = re.compile("```((?:.|\n)+?)```")
+# Characters that may precede an opening marker in addition to whitespace. The other markers are
+# allowed so that formatting can be nested, e.g. _*bold italic*_
+_prefixes = {
+    "_": ">~*",
+    "*": ">_~",
+    "~": ">_*",
+}
+_tags = {
+    "_": ("<em>", "</em>"),
+    "*": ("<strong>", "</strong>"),
+    "~": ("<del>", "</del>"),
+}
+_markers = re.compile(r"[_*~]")
+_code_fence = "```"
 
+Replacements = Dict[int, Tuple[str, int]]
 
-def code_block_repl(match: Match) -> str:
-    text = match.group(1)
-    if "\n" in text:
-        return f"<pre><code>{text}</code></pre>"
-    return f"<code>{text}</code>"
+
+def _is_word_char(char: str) -> bool:
+    return "a" <= char <= "z" or "A" <= char <= "Z" or char.isdecimal()
+
+
+def _find_spans(text: str, marker: str, indices: List[int], replacements: Replacements
+                ) -> None:
+    """
+    Find the spans formatted with the given marker and add their tags to ``replacements``.
+
+    A span starts with a marker at the start of the text or after whitespace or one of the
+    allowed prefix characters, and ends at the first marker on the same line that is at least
+    one character later and isn't followed by a letter or digit. The character after the closing
+    marker can't start another span.
+    """
+    length = len(text)
+    count = len(indices)
+    # valid_close[i] is the first index >= i in indices that is a possible closing marker
+    valid_close = [count] * (count + 1)
+    for i in range(count - 1, -1, -1):
+        next_char = indices[i] + 1
+        valid_close[i] = (i if next_char == length or not _is_word_char(text[next_char])
+                          else valid_close[i + 1])
+
+    prefixes = _prefixes[marker]
+    open_tag, close_tag = _tags[marker]
+    consumed = 0
+    i = 0
+    while i < count:
+        start = indices[i]
+        if start > 0:
+            prev_char = text[start - 1]
+            if start - 1 < consumed or not (prev_char in prefixes or prev_char.isspace()):
+                i += 1
+                continue
+        j = valid_close[i + 1]
+        if j < count and indices[j] == start + 1:
+            j = valid_close[j + 1]
+        if j == count:
+            # Later markers have even fewer possible closing markers
+            break
+        end = indices[j]
+        if text.find("\n", start + 1, end) != -1:
+            i += 1
+            continue
+        replacements[start] = open_tag, 1
+        replacements[end] = close_tag, 1
+        # The character after the closing marker is consumed, unless it's a marker that was
+        # already converted to a tag, in which case the '>' at the end of the tag isn't.
+        consumed = end + 1 if end + 1 in replacements else end + 2
+        i = j + 1
+
+
+def _find_code_blocks(text: str, replacements: Replacements) -> None:
+    fence_len = len(_code_fence)
+    start = text.find(_code_fence)
+    while start != -1:
+        end = text.find(_code_fence, start + fence_len + 1)
+        if end == -1:
+            return
+        if text.find("\n", start, end) != -1:
+            replacements[start] = "<pre><code>", fence_len
+            replacements[end] = "</code></pre>", fence_len
+        else:
+            replacements[start] = "<code>", fence_len
+            replacements[end] = "</code>", fence_len
+        start = text.find(_code_fence, end + fence_len)
 
 
 def whatsapp_to_matrix(text: str) -> Tuple[Optional[str], str]:
-    html = italic.sub(r"\1<em>\2</em>\3", text)
-    html = bold.sub(r"\1<strong>\2</strong>\3", html)
-    html = strike.sub(r"\1<del>\2</del>\3", html)
-    html = code_block.sub(code_block_repl, html)
-    if html != text:
-        return html.replace("\n", "<br/>"), text
-    return None, text
+    has_code = _code_fence in text
+    if not has_code and not _markers.search(text):
+        return None, text
+
+    indices: Dict[str, List[int]] = {marker: [] for marker in _tags}
+    for match in _markers.finditer(text):
+        indices[match.group()].append(match.start())
+    replacements: Replacements = {}
+    for marker, marker_indices in indices.items():
+        if marker_indices:
+            _find_spans(text, marker, marker_indices, replacements)
+    if has_code:
+        _find_code_blocks(text, replacements)
+    if not replacements:
+        return None, text
+
+    parts = []
+    prev_end = 0
+    for index in sorted(replacements):
+        tag, length = replacements[index]
+        parts.append(text[prev_end:index])
+        parts.append(tag)
+        prev_end = index + length
+    parts.append(text[prev_end:])
+    return "".join(parts).replace("\n", "<br/>"), text
@@ -16,7 +16,7 @@
 from typing import Optional
 import asyncio
 
-from mautrix.types import UserID, RoomID, Event, MessageEvent, StateEvent
+from mautrix.types import UserID, RoomID, Event, EventType, MessageEvent, StateEvent
 from mautrix.appservice import AppService
 from mautrix.bridge import BaseMatrixHandler
 
@@ -34,15 +34,22 @@ class MatrixHandler(BaseMatrixHandler):
         return u.User.get(user_id)
 
     async def get_portal(self, room_id: RoomID) -> 'po.Portal':
-        return po.Portal.get_by_mxid(room_id)
+        return await po.Portal.get_by_mxid(room_id)
 
     async def get_puppet(self, user_id: UserID) -> 'pu.Puppet':
-        return pu.Puppet.get_by_mxid(user_id)
+        return await pu.Puppet.get_by_mxid(user_id)
 
     @staticmethod
     async def allow_bridging_message(user: 'u.User', portal: 'po.Portal') -> bool:
         return user.is_whitelisted
 
+    async def int_handle_event(self, evt: Event) -> None:
+        if evt.type == EventType.ROOM_MEMBER:
+            portal = po.Portal.by_mxid.get(evt.room_id)
+            if portal:
+                portal.update_member(UserID(evt.state_key), evt.content)
+        await super().int_handle_event(evt)
+
     def filter_matrix_event(self, evt: Event) -> bool:
         if not isinstance(evt, (MessageEvent, StateEvent)):
             return True
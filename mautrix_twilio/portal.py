@@ -13,22 +13,24 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Dict, Optional, List, Any, TYPE_CHECKING
-from string import Template
-from html import escape
+from typing import Dict, Optional, List, Tuple, Iterator, Any, TYPE_CHECKING
+from itertools import count
 import mimetypes
 import asyncio
 
 from mautrix.types import (RoomID, UserID, EventID, EventType, StrippedStateEvent, MessageType,
                            MessageEventContent, TextMessageEventContent, Format, FileInfo,
-                           MediaMessageEventContent, PowerLevelStateEventContent)
+                           MediaMessageEventContent, PowerLevelStateEventContent, ContentURI,
+                           MemberStateEventContent, Membership)
 from mautrix.bridge import BasePortal
 from mautrix.appservice import IntentAPI
 
-from .db import Portal as DBPortal, Message as DBMessage
+from .db import Portal as DBPortal, Message as DBMessage, OutboxMessage as DBOutboxMessage
 from .twilio import (TwilioUserID, TwilioMessageID, TwilioClient, TwilioMessageEvent,
-                     TwilioStatusEvent, TwilioMessageStatus)
-from .formatter import whatsapp_to_matrix, matrix_to_whatsapp
+                     TwilioStatusEvent, TwilioMessageStatus, TwilioMedia)
+from .formatter import whatsapp_to_matrix, MessageTemplate
+from .util import (relay_media, KeyedDispatcher, CorrelationIndex, BoundedRegistry, MediaCache,
+                   MediaTooLargeError, EntityLogger, RoomPool)
 from . import puppet as p, user as u
 
 if TYPE_CHECKING:
@@ -37,16 +39,26 @@ if TYPE_CHECKING:
 
 class Portal(BasePortal):
     homeserver_address: str
-    message_template: Template
+    max_media_size: int
+    media_concurrency: int
+    media_cache: Optional[MediaCache]
+    message_template: MessageTemplate
     bridge_notices: bool
     federate_rooms: bool
     invite_users: List[UserID]
     initial_state: Dict[str, Dict[str, Any]]
+    room_pool: Optional[RoomPool]
 
     twc: TwilioClient
+    inbox: KeyedDispatcher
+    outbox: KeyedDispatcher
+    sent_messages: CorrelationIndex[TwilioMessageID, Tuple[EventID, int]]
+    status_wait_timeout: float
+    receipt_coalesce_window: float
+    _send_counter: Iterator[int] = count(1)
 
     by_mxid: Dict[RoomID, 'Portal'] = {}
-    by_twid: Dict[TwilioUserID, 'Portal'] = {}
+    by_twid: BoundedRegistry[TwilioUserID, 'Portal']
 
     twid: TwilioUserID
     mxid: Optional[RoomID]
@@ -56,6 +68,13 @@ class Portal(BasePortal):
     _main_intent: Optional[IntentAPI]
     _create_room_lock: asyncio.Lock
     _send_lock: asyncio.Lock
+    _sends_in_flight: int
+    _pending_receipts: Dict[TwilioMessageStatus, EventID]
+    _receipt_order: Dict[TwilioMessageStatus, int]
+    _receipt_task: Optional[asyncio.Task]
+    _member_names: Dict[UserID, Optional[str]]
+    _members_loaded: bool
+    _member_task: Optional[asyncio.Task]
 
     def __init__(self, twid: TwilioUserID, mxid: Optional[RoomID] = None,
                  db_instance: Optional[DBPortal] = None) -> None:
@@ -67,12 +86,30 @@ class Portal(BasePortal):
         self._main_intent = None
         self._create_room_lock = asyncio.Lock()
         self._send_lock = asyncio.Lock()
-        self.log = self.log.getChild(self.twid)
+        self._sends_in_flight = 0
+        self._pending_receipts = {}
+        self._receipt_order = {}
+        self._receipt_task = None
+        self._member_names = {}
+        self._members_loaded = False
+        self._member_task = None
+        self.log = EntityLogger(self.log, self.twid)
 
         self.by_twid[self.twid] = self
         if self.mxid:
             self.by_mxid[self.mxid] = self
 
+    @property
+    def is_busy(self) -> bool:
+        return (self._create_room_lock.locked() or self._send_lock.locked()
+                or self._sends_in_flight > 0 or self._receipt_task is not None
+                or self._member_task is not None
+                or self.outbox.is_active(self.twid) or self.inbox.is_active(self.twid))
+
+    def _unload(self) -> None:
+        if self.mxid and self.by_mxid.get(self.mxid) is self:
+            del self.by_mxid[self.mxid]
+
     @property
     def db_instance(self) -> DBPortal:
         if not self._db_instance:
@@ -83,19 +120,19 @@ class Portal(BasePortal):
     def from_db(cls, db_portal: DBPortal) -> 'Portal':
         return Portal(twid=db_portal.twid, mxid=db_portal.mxid, db_instance=db_portal)
 
-    def save(self) -> None:
-        self.db_instance.edit(mxid=self.mxid)
+    async def save(self) -> None:
+        await self.db_instance.edit(mxid=self.mxid)
 
-    def delete(self) -> None:
+    async def delete(self) -> None:
         self.by_twid.pop(self.twid, None)
         self.by_mxid.pop(self.mxid, None)
         if self._db_instance:
-            self._db_instance.delete()
+            await self._db_instance.delete()
 
     @property
     def main_intent(self) -> IntentAPI:
         if not self._main_intent:
-            self._main_intent = p.Puppet.get_by_twid(self.twid).intent
+            self._main_intent = self.az.intent.user(p.Puppet.get_mxid_from_twid(self.twid))
         return self._main_intent
 
     async def create_matrix_room(self) -> RoomID:
@@ -111,60 +148,115 @@ class Portal(BasePortal):
         if self.mxid:
             return self.mxid
 
-        self.log.debug("Creating Matrix room")
-        puppet = p.Puppet.get_by_twid(self.twid)
-        await puppet.update_displayname()
-        creation_content = {
-            "m.federate": self.federate_rooms
+        puppet = await p.Puppet.get_by_twid(self.twid)
+        pooled_mxid = await self.room_pool.claim() if self.room_pool is not None else None
+        if pooled_mxid:
+            self.log.debug(f"Claiming pooled Matrix room {pooled_mxid}")
+            try:
+                await self._claim_pooled_room(pooled_mxid, puppet)
+                self.mxid = pooled_mxid
+            except Exception:
+                # The room may be half set up, so it can't go back into the pool
+                self.log.warning(f"Failed to claim pooled room {pooled_mxid}, abandoning it and "
+                                 "creating a new room", exc_info=True)
+        if not self.mxid:
+            self.log.debug("Creating Matrix room")
+            initial_state = self.get_initial_state(self.az.bot_mxid, self.main_intent.mxid)
+            _, self.mxid = await asyncio.gather(
+                puppet.ensure_displayname(),
+                self.main_intent.create_room(name=puppet.displayname,
+                                             invitees=[self.az.bot_mxid, *self.invite_users],
+                                             is_direct=True,
+                                             creation_content=self.get_creation_content(),
+                                             initial_state=list(initial_state.values())))
+            if not self.mxid:
+                raise Exception("Failed to create room: no mxid received")
+        self.by_mxid[self.mxid] = self
+        await self.save()
+        self.log.debug(f"Matrix room set up: {self.mxid}")
+        return self.mxid
+
+    async def _claim_pooled_room(self, mxid: RoomID, puppet: 'p.Puppet') -> None:
+        bot = self.az.intent
+        initial_state = self.get_initial_state(self.az.bot_mxid, self.main_intent.mxid)
+
+        async def add_puppet() -> None:
+            await bot.invite_user(mxid, self.main_intent.mxid)
+            await self.main_intent.join_room_by_id(mxid)
+
+        await asyncio.gather(puppet.ensure_displayname(), add_puppet(),
+                             bot.set_room_name(mxid, puppet.displayname),
+                             bot.set_power_levels(
+                                 mxid, initial_state[EventType.ROOM_POWER_LEVELS].content))
+
+    @classmethod
+    def get_creation_content(cls) -> Dict[str, Any]:
+        return {
+            "m.federate": cls.federate_rooms
         }
+
+    @classmethod
+    def get_initial_state(cls, *admins: UserID) -> Dict[EventType, StrippedStateEvent]:
         initial_state = {EventType.find(event_type): StrippedStateEvent.deserialize({
             "type": event_type,
             "state_key": "",
             "content": content
-        }) for event_type, content in self.initial_state.items()}
+        }) for event_type, content in cls.initial_state.items()}
         if EventType.ROOM_POWER_LEVELS not in initial_state:
             initial_state[EventType.ROOM_POWER_LEVELS] = StrippedStateEvent(
                 type=EventType.ROOM_POWER_LEVELS, content=PowerLevelStateEventContent())
         plc = initial_state[EventType.ROOM_POWER_LEVELS].content
-        plc.users[self.az.bot_mxid] = 100
-        plc.users[self.main_intent.mxid] = 100
-        for user_id in self.invite_users:
+        for user_id in admins:
+            plc.users[user_id] = 100
+        for user_id in cls.invite_users:
             plc.users.setdefault(user_id, 100)
-        self.mxid = await self.main_intent.create_room(name=puppet.displayname,
-                                                       invitees=[self.az.bot_mxid,
-                                                                 *self.invite_users],
-                                                       is_direct=True,
-                                                       creation_content=creation_content,
-                                                       initial_state=list(initial_state.values()))
-        if not self.mxid:
-            raise Exception("Failed to create room: no mxid received")
-        self.save()
-        self.log.debug(f"Matrix room created: {self.mxid}")
-        self.by_mxid[self.mxid] = self
-        await self.main_intent.join_room_by_id(self.mxid)
-        return self.mxid
+        return initial_state
+
+    async def _send_media(self, twid: TwilioMessageID, mxc: ContentURI, mime: str, size: int
+                          ) -> EventID:
+        msgtype = MessageType.FILE
+        if mime.startswith("image/"):
+            msgtype = MessageType.IMAGE
+        elif mime.startswith("video/"):
+            msgtype = MessageType.VIDEO
+        elif mime.startswith("audio/"):
+            msgtype = MessageType.AUDIO
+        ext = mimetypes.guess_extension(mime)
+        content = MediaMessageEventContent(body=f"{twid}{ext}", msgtype=msgtype, url=mxc,
+                                           info=FileInfo(size=size, mimetype=mime))
+        return await self.main_intent.send_message(self.mxid, content)
 
     async def handle_twilio_message(self, message: TwilioMessageEvent) -> None:
+        if await DBMessage.get_by_twid(message.id, self.db_instance.id):
+            self.log.debug(f"Ignoring already bridged message {message.id}")
+            return
         if not await self.create_matrix_room():
             return
         mxid = None
 
         if message.media:
-            resp = await self.az.http_session.get(message.media.url)
-            data = await resp.read()
-            mime = message.media.mime_type
-            mxc = await self.main_intent.upload_media(data, mime)
-            msgtype = MessageType.FILE
-            if mime.startswith("image/"):
-                msgtype = MessageType.IMAGE
-            elif mime.startswith("video/"):
-                msgtype = MessageType.VIDEO
-            elif mime.startswith("audio/"):
-                msgtype = MessageType.AUDIO
-            ext = mimetypes.guess_extension(mime)
-            content = MediaMessageEventContent(body=f"{message.id}{ext}", msgtype=msgtype, url=mxc,
-                                               info=FileInfo(size=len(data), mimetype=mime))
-            mxid = await self.main_intent.send_message(self.mxid, content)
+            semaphore = asyncio.Semaphore(self.media_concurrency)
+
+            async def relay(media: TwilioMedia) -> Tuple[ContentURI, int]:
+                async with semaphore:
+                    return await relay_media(self.twc.media_http, media.url, self.main_intent,
+                                             media.mime_type, self.max_media_size,
+                                             self.media_cache)
+
+            results = await asyncio.gather(*(relay(media) for media in message.media),
+                                           return_exceptions=True)
+            for media, result in zip(message.media, results):
+                if isinstance(result, MediaTooLargeError):
+                    self.log.debug(f"Not bridging media in {message.id}: too large")
+                    mxid = await self.main_intent.send_notice(self.mxid,
+                                                              "Media too large to bridge")
+                elif isinstance(result, Exception):
+                    self.log.error(f"Failed to bridge media in {message.id}", exc_info=result)
+                    mxid = await self.main_intent.send_notice(self.mxid,
+                                                              "Failed to bridge media")
+                else:
+                    mxc, size = result
+                    mxid = await self._send_media(message.id, mxc, media.mime_type, size)
 
         if message.body:
             html, text = whatsapp_to_matrix(message.body)
@@ -177,22 +269,92 @@ class Portal(BasePortal):
         if not mxid:
             mxid = await self.main_intent.send_notice(self.mxid, "Message with unknown content")
 
-        msg = DBMessage(mxid=mxid, mx_room=self.mxid, tw_receiver=self.twid, twid=message.id)
-        msg.insert()
+        await DBMessage(portal_id=self.db_instance.id, twid=message.id,
+                        mxid=mxid).insert_buffered()
 
     async def handle_twilio_status(self, status: TwilioStatusEvent) -> None:
         if not self.mxid:
             return
-        async with self._send_lock:
-            msg = DBMessage.get_by_twid(status.id, self.twid)
-            if status.status == TwilioMessageStatus.DELIVERED:
-                await self.az.intent.mark_read(self.mxid, msg.mxid)
-            elif status.status == TwilioMessageStatus.READ:
-                await self.main_intent.mark_read(self.mxid, msg.mxid)
-            elif status.status == TwilioMessageStatus.UNDELIVERED:
-                await self.az.intent.react(self.mxid, msg.mxid, "\u274c")
-            elif status.status == TwilioMessageStatus.FAILED:
-                await self.az.intent.react(self.mxid, msg.mxid, "\u274c")
+        sent = await self._find_sent_message(status.id)
+        if not sent:
+            self.log.debug(f"Ignoring {status.status} status of unknown message {status.id}")
+            return
+        event_id, order = sent
+        if status.status in (TwilioMessageStatus.DELIVERED, TwilioMessageStatus.READ):
+            self._queue_receipt(status.status, event_id, order)
+        elif status.status in (TwilioMessageStatus.UNDELIVERED, TwilioMessageStatus.FAILED):
+            async with self._send_lock:
+                await self.az.intent.react(self.mxid, event_id, "\u274c")
+
+    async def _find_sent_message(self, twid: TwilioMessageID) -> Optional[Tuple[EventID, int]]:
+        sent = self.sent_messages.get(twid)
+        if sent:
+            return sent
+        msg = await DBMessage.get_by_twid(twid, self.db_instance.id)
+        if msg:
+            # Messages that are only in the database are older than anything in the index
+            return msg.mxid, 0
+        if self._sends_in_flight > 0:
+            # Twilio may send the status callback before the send response has been handled
+            return await self.sent_messages.wait(twid, timeout=self.status_wait_timeout)
+        return None
+
+    def _queue_receipt(self, status: TwilioMessageStatus, event_id: EventID, order: int) -> None:
+        if order < self._receipt_order.get(status, -1):
+            return
+        self._receipt_order[status] = order
+        self._pending_receipts[status] = event_id
+        if not self._receipt_task:
+            self._receipt_task = self.loop.create_task(self._send_receipts())
+
+    async def _send_receipts(self) -> None:
+        # Wait for the rest of the burst, then only mark the newest message as read
+        await asyncio.sleep(self.receipt_coalesce_window)
+        self._receipt_task = None
+        receipts, self._pending_receipts = self._pending_receipts, {}
+        for status, event_id in receipts.items():
+            intent = self.main_intent if status == TwilioMessageStatus.READ else self.az.intent
+            try:
+                await intent.mark_read(self.mxid, event_id)
+            except Exception:
+                self.log.exception(f"Failed to send {status} receipt for {event_id}")
+
+    async def _load_members(self) -> None:
+        try:
+            members = await self.az.intent.get_joined_members(self.mxid)
+        except Exception:
+            self.log.warning("Failed to load room members", exc_info=True)
+            return
+        finally:
+            self._member_task = None
+        for user_id, member in members.items():
+            # Don't overwrite anything that was updated by a member event while loading
+            self._member_names.setdefault(user_id, member.displayname)
+        self._members_loaded = True
+
+    def update_member(self, user_id: UserID, content: MemberStateEventContent) -> None:
+        if content.membership == Membership.JOIN:
+            self._member_names[user_id] = content.displayname
+        else:
+            self._member_names.pop(user_id, None)
+
+    async def get_member_displayname(self, user_id: UserID) -> Optional[str]:
+        try:
+            return self._member_names[user_id]
+        except KeyError:
+            pass
+        if not self._members_loaded:
+            # Load the whole member list the first time a name is needed instead of fetching
+            # each sender separately
+            if not self._member_task:
+                self._member_task = self.loop.create_task(self._load_members())
+            await asyncio.shield(self._member_task)
+            try:
+                return self._member_names[user_id]
+            except KeyError:
+                pass
+        displayname = await self.az.intent.get_room_displayname(self.mxid, user_id)
+        return self._member_names.setdefault(user_id, displayname)
 
     async def handle_matrix_message(self, sender: 'u.User', message: MessageEventContent,
                                     event_id: EventID) -> None:
@@ -200,51 +362,103 @@ class Portal(BasePortal):
             if message.msgtype == MessageType.TEXT or (message.msgtype == MessageType.NOTICE
                                                        and self.bridge_notices):
                 localpart, _ = self.az.intent.parse_user_id(sender.mxid)
-                html = (message.formatted_body if message.format == Format.HTML
-                        else escape(message.body))
-                html = self.message_template.safe_substitute(
-                    message=html, mxid=sender.mxid, localpart=localpart,
-                    displayname=await self.az.intent.get_room_displayname(self.mxid, sender.mxid))
-                text = matrix_to_whatsapp(html)
-                resp = await self.twc.send_message(self.twid, text)
+                values = dict(mxid=sender.mxid, localpart=localpart,
+                              displayname=await self.get_member_displayname(sender.mxid))
+                if message.format == Format.HTML:
+                    text = self.message_template.render_html(message.formatted_body, **values)
+                else:
+                    text = self.message_template.render_text(message.body, **values)
+                media = None
             elif message.msgtype in (MessageType.AUDIO, MessageType.VIDEO, MessageType.IMAGE,
                                      MessageType.FILE):
-                url = f"{self.homeserver_address}/_matrix/media/r0/download/{message.url[6:]}"
-                resp = await self.twc.send_message(self.twid, media=url)
+                text = None
+                media = f"{self.homeserver_address}/_matrix/media/r0/download/{message.url[6:]}"
             else:
                 self.log.debug(f"Ignoring unknown message {message}")
                 return
+            entry = DBOutboxMessage(mxid=event_id, mx_room=self.mxid, tw_receiver=self.twid,
+                                    body=text, media=media)
+            await entry.insert()
+            self._queue_outbox(entry)
+
+    def _queue_outbox(self, entry: DBOutboxMessage) -> None:
+        self.outbox.dispatch(self.twid, lambda: self._deliver_outbox(entry))
+
+    async def _deliver_outbox(self, entry: DBOutboxMessage) -> None:
+        self._sends_in_flight += 1
+        try:
+            resp = await self.twc.send_message(self.twid, body=entry.body, media=entry.media)
+            self.sent_messages.put(TwilioMessageID(resp["sid"]),
+                                   (entry.mxid, next(self._send_counter)))
+        except asyncio.CancelledError:
+            # Leave the entry in the outbox so it's resent after a restart
+            raise
+        except Exception:
+            self.log.exception(f"Failed to send {entry.mxid} to Twilio")
+            resp = None
+        finally:
+            self._sends_in_flight -= 1
+        if resp:
             self.log.debug(f"Twilio send response: {resp}")
-            DBMessage(mxid=event_id, mx_room=self.mxid, tw_receiver=self.twid,
-                      twid=TwilioMessageID(resp["sid"])).insert()
+            await DBMessage(portal_id=self.db_instance.id, twid=TwilioMessageID(resp["sid"]),
+                            mxid=entry.mxid).insert_buffered()
+        else:
+            try:
+                await self.az.intent.react(entry.mx_room, entry.mxid, "\u274c")
+            except Exception:
+                self.log.exception(f"Failed to mark {entry.mxid} as failed")
+        await entry.delete()
+
+    @classmethod
+    async def resume_outbox(cls) -> None:
+        pending = 0
+        for entry in await DBOutboxMessage.all():
+            portal = await cls.get_by_twid(entry.tw_receiver, create=False)
+            if portal:
+                portal._queue_outbox(entry)
+                pending += 1
+            else:
+                await entry.delete()
+        if pending > 0:
+            cls.log.info(f"Resuming {pending} pending outgoing messages")
 
     @classmethod
-    def get_by_mxid(cls, mxid: RoomID) -> Optional['Portal']:
+    async def get_by_mxid(cls, mxid: RoomID) -> Optional['Portal']:
         try:
             return cls.by_mxid[mxid]
         except KeyError:
             pass
 
-        db_portal = DBPortal.get_by_mxid(mxid)
+        db_portal = await DBPortal.get_by_mxid(mxid)
+        try:
+            # The portal may have been loaded while waiting for the database
+            return cls.by_mxid[mxid]
+        except KeyError:
+            pass
         if db_portal:
             return cls.from_db(db_portal)
 
         return None
 
     @classmethod
-    def get_by_twid(cls, twid: TwilioUserID, create: bool = True) -> Optional['Portal']:
+    async def get_by_twid(cls, twid: TwilioUserID, create: bool = True) -> Optional['Portal']:
         try:
             return cls.by_twid[twid]
         except KeyError:
             pass
 
-        db_portal = DBPortal.get_by_twid(twid)
+        db_portal = await DBPortal.get_by_twid(twid)
+        try:
+            # The portal may have been loaded while waiting for the database
+            return cls.by_twid[twid]
+        except KeyError:
+            pass
         if db_portal:
             return cls.from_db(db_portal)
 
         if create:
             portal = cls(twid=twid)
-            portal.db_instance.insert()
+            await portal.db_instance.insert()
             return portal
 
         return None
@@ -253,9 +467,34 @@ class Portal(BasePortal):
 def init(context: 'Context') -> None:
     Portal.az, config, Portal.loop = context.core
     Portal.twc = context.twc
+    Portal.inbox = context.tw.dispatcher
+    Portal.by_twid = BoundedRegistry("portal", max_size=config["bridge.cache.portal.max_size"],
+                                     idle_timeout=config["bridge.cache.portal.idle_timeout"],
+                                     can_evict=lambda portal: not portal.is_busy,
+                                     on_evict=Portal._unload)
+    Portal.outbox = KeyedDispatcher(concurrency=config["twilio.max_concurrent_portals"],
+                                    idle_timeout=config["twilio.portal_worker_idle_timeout"],
+                                    loop=Portal.loop)
+    Portal.sent_messages = CorrelationIndex(config["twilio.status.index_size"], loop=Portal.loop)
+    Portal.status_wait_timeout = config["twilio.status.wait_timeout"]
+    Portal.receipt_coalesce_window = config["twilio.status.coalesce_window"]
     Portal.homeserver_address = config["homeserver.public_address"]
-    Portal.message_template = Template(config["bridge.message_template"])
+    Portal.message_template = MessageTemplate(config["bridge.message_template"])
     Portal.bridge_notices = config["bridge.bridge_notices"]
+    Portal.max_media_size = config["bridge.max_media_size"] * 1024 ** 2
+    Portal.media_concurrency = config["bridge.media_concurrency"]
+    max_file_size = config["bridge.media_cache.max_file_size"] * 1024 ** 2
+    Portal.media_cache = (MediaCache(max_file_size=max_file_size,
+                                     memory_size=config["bridge.media_cache.memory_size"],
+                                     retention=config["bridge.media_cache.retention"] * 86400,
+                                     loop=Portal.loop)
+                          if config["bridge.media_cache.enabled"] else None)
     Portal.federate_rooms = config["bridge.federate_rooms"]
     Portal.invite_users = config["bridge.invite_users"]
     Portal.initial_state = config["bridge.initial_state"]
+    Portal.room_pool = (RoomPool(Portal.az, size=config["bridge.room_pool.size"],
+                                 creation_content=Portal.get_creation_content(),
+                                 initial_state=list(Portal.get_initial_state(
+                                     Portal.az.bot_mxid).values()),
+                                 invitees=Portal.invite_users, loop=Portal.loop)
+                        if config["bridge.room_pool.size"] > 0 else None)
@@ -13,15 +13,17 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, Dict, TYPE_CHECKING
+from typing import Optional, TYPE_CHECKING
+import asyncio
 
 from mautrix.types import UserID
 from mautrix.bridge import BasePuppet
 from mautrix.util.simple_template import SimpleTemplate
 
 from .config import Config
-from .db import Puppet as DBPuppet
+from .db import Puppet as DBPuppet, BridgeState as DBBridgeState
 from .twilio import TwilioUserID
+from .util import BoundedRegistry, EntityLogger, LRUCache
 
 if TYPE_CHECKING:
     from .context import Context
@@ -33,6 +35,38 @@ except ImportError:
 
 config: Config
 
+_NOT_CACHED = object()
+DISPLAYNAME_TEMPLATE_KEY = "puppet_displayname_template"
+
+
+class PuppetIdentity:
+    """The identifiers of a puppet, derived from its Twilio ID once when the puppet is loaded."""
+    __slots__ = ("twid", "number", "mxid", "displayname")
+
+    twid: TwilioUserID
+    number: int
+    mxid: UserID
+    displayname: str
+
+    def __init__(self, twid: TwilioUserID, number: int, mxid: UserID, displayname: str) -> None:
+        self.twid = twid
+        self.number = number
+        self.mxid = mxid
+        self.displayname = displayname
+
+    @classmethod
+    def from_twid(cls, twid: TwilioUserID) -> 'PuppetIdentity':
+        number = Puppet.twid_template.parse(twid)
+        if phonenumbers:
+            parsed = phonenumbers.parse(f"+{number}")
+            fmt = phonenumbers.PhoneNumberFormat.INTERNATIONAL
+            formatted_number = phonenumbers.format_number(parsed, fmt)
+        else:
+            formatted_number = f"+{number}"
+        return cls(twid=twid, number=number,
+                   mxid=UserID(Puppet.mxid_template.format_full(str(number))),
+                   displayname=Puppet.displayname_template.format_full(formatted_number))
+
 
 class Puppet(BasePuppet):
     hs_domain: str
@@ -40,93 +74,194 @@ class Puppet(BasePuppet):
     mxid_template: SimpleTemplate[str]
     displayname_template: SimpleTemplate[str]
 
-    by_twid: Dict[TwilioUserID, 'Puppet'] = {}
+    by_twid: BoundedRegistry[TwilioUserID, 'Puppet']
+    twid_by_mxid: LRUCache[UserID, Optional[TwilioUserID]]
+    registered_cache: LRUCache[UserID, bool]
+    displayname_sync_concurrency: int
+    _displayname_sync_task: Optional[asyncio.Task] = None
 
     twid: TwilioUserID
-    _formatted_number: Optional[str]
+    identity: PuppetIdentity
+    profile_displayname: Optional[str]
 
     _db_instance: Optional[DBPuppet]
+    _displayname_lock: asyncio.Lock
 
     def __init__(self, twid: TwilioUserID, is_registered: bool = False,
+                 profile_displayname: Optional[str] = None,
                  db_instance: Optional[DBPuppet] = None) -> None:
         super().__init__()
         self.twid = twid
         self.is_registered = is_registered
-        self._formatted_number = None
+        self.profile_displayname = profile_displayname
+        self.identity = PuppetIdentity.from_twid(twid)
         self._db_instance = db_instance
+        self._displayname_lock = asyncio.Lock()
         self.intent = self.az.intent.user(self.mxid)
-        self.log = self.log.getChild(self.twid)
+        self.log = EntityLogger(self.log, self.twid)
         self.by_twid[self.twid] = self
 
     @property
-    def phone_number(self) -> int:
-        return self.twid_template.parse(self.twid)
+    def is_busy(self) -> bool:
+        return self._displayname_lock.locked()
 
     @property
-    def formatted_phone_number(self) -> str:
-        if not self._formatted_number:
-            parsed = phonenumbers.parse(f"+{self.phone_number}")
-            fmt = phonenumbers.PhoneNumberFormat.INTERNATIONAL
-            self._formatted_number = phonenumbers.format_number(parsed, fmt)
-        return self._formatted_number
+    def phone_number(self) -> int:
+        return self.identity.number
 
     @property
     def mxid(self) -> UserID:
-        return UserID(self.mxid_template.format_full(str(self.phone_number)))
+        return self.identity.mxid
 
     @property
     def displayname(self) -> str:
-        return self.displayname_template.format_full(self.formatted_phone_number)
+        return self.identity.displayname
 
     @property
     def db_instance(self) -> DBPuppet:
         if not self._db_instance:
-            self._db_instance = DBPuppet(twid=self.twid, matrix_registered=self.is_registered)
+            self._db_instance = DBPuppet(twid=self.twid, matrix_registered=self.is_registered,
+                                         displayname=self.profile_displayname)
         return self._db_instance
 
     @classmethod
     def from_db(cls, db_puppet: DBPuppet) -> 'Puppet':
-        return cls(twid=db_puppet.twid, is_registered=db_puppet.matrix_registered,
-                   db_instance=db_puppet)
+        puppet = cls(twid=db_puppet.twid, is_registered=db_puppet.matrix_registered,
+                     profile_displayname=db_puppet.displayname, db_instance=db_puppet)
+        # Remembered for the state store, so that it doesn't query the database after eviction
+        cls.registered_cache[puppet.mxid] = puppet.is_registered
+        return puppet
 
-    def save(self) -> None:
-        self.db_instance.edit(matrix_registered=self.is_registered)
+    async def save(self) -> None:
+        await self.db_instance.edit(matrix_registered=self.is_registered,
+                                    displayname=self.profile_displayname)
 
-    async def update_displayname(self) -> None:
-        await self.intent.set_displayname(self.displayname)
+    async def update_displayname(self) -> bool:
+        async with self._displayname_lock:
+            if self.profile_displayname == self.displayname:
+                return False
+            await self.intent.set_displayname(self.displayname)
+            self.profile_displayname = self.displayname
+            await self.save()
+            return True
+
+    async def ensure_displayname(self) -> None:
+        # Outdated displaynames are updated in the background by sync_displaynames
+        if self.profile_displayname is None:
+            await self.update_displayname()
 
     @classmethod
-    def get_by_twid(cls, twid: TwilioUserID, create: bool = True) -> Optional['Puppet']:
+    async def sync_displaynames(cls, batch_size: int = 1000) -> None:
+        """Update the displaynames that were set with a different displayname template."""
+        template = config["bridge.displayname_template"]
+        if await DBBridgeState.get(DISPLAYNAME_TEMPLATE_KEY) == template:
+            return
+
+        sema = asyncio.Semaphore(cls.displayname_sync_concurrency)
+        updated = failed = 0
+
+        async def update(db_puppet: DBPuppet, identity: PuppetIdentity) -> None:
+            nonlocal updated, failed
+            async with sema:
+                # Only use puppets that are already loaded, so that the sync doesn't push the
+                # active ones out of the cache
+                puppet = cls.by_twid.peek(db_puppet.twid)
+                try:
+                    if puppet:
+                        await puppet.update_displayname()
+                    else:
+                        await cls.az.intent.user(identity.mxid).set_displayname(
+                            identity.displayname)
+                        await db_puppet.edit(matrix_registered=True,
+                                             displayname=identity.displayname)
+                    updated += 1
+                except Exception:
+                    failed += 1
+                    cls.log.exception(f"Failed to update displayname of {db_puppet.twid}")
+
+        cls.log.info("Displayname template changed, updating puppet displaynames")
+        after = None
+        while True:
+            # Go through the table one page at a time, so that it isn't all loaded at once
+            page = await DBPuppet.page_with_profile(after, batch_size)
+            if not page:
+                break
+            after = page[-1].twid
+            outdated = []
+            for db_puppet in page:
+                identity = PuppetIdentity.from_twid(db_puppet.twid)
+                if db_puppet.displayname != identity.displayname:
+                    outdated.append(update(db_puppet, identity))
+            if outdated:
+                await asyncio.gather(*outdated)
+            else:
+                # Formatting phone numbers isn't free, so let other tasks run in between
+                await asyncio.sleep(0)
+        if failed:
+            # Leave the old template stored, so that the failed ones are retried on restart
+            cls.log.warning(f"Updated displaynames of {updated} puppets, {failed} failed")
+            return
+        await DBBridgeState.set(DISPLAYNAME_TEMPLATE_KEY, template)
+        cls.log.info(f"Finished updating displaynames of {updated} puppets")
+
+    @classmethod
+    async def start_displayname_sync(cls) -> None:
+        cls._displayname_sync_task = cls.loop.create_task(cls.sync_displaynames())
+
+    @classmethod
+    async def stop_displayname_sync(cls) -> None:
+        if cls._displayname_sync_task:
+            cls._displayname_sync_task.cancel()
+            cls._displayname_sync_task = None
+
+    @classmethod
+    async def get_by_twid(cls, twid: TwilioUserID, create: bool = True) -> Optional['Puppet']:
         try:
             return cls.by_twid[twid]
         except KeyError:
             pass
 
-        db_puppet = DBPuppet.get_by_twid(twid)
+        db_puppet = await DBPuppet.get_by_twid(twid)
+        try:
+            # The puppet may have been loaded while waiting for the database
+            return cls.by_twid[twid]
+        except KeyError:
+            pass
         if db_puppet:
             return cls.from_db(db_puppet)
 
         if create:
             puppet = cls(twid)
-            puppet.db_instance.insert()
+            await puppet.db_instance.insert()
             return puppet
 
         return None
 
     @classmethod
-    def get_by_mxid(cls, mxid: UserID, create: bool = True) -> Optional['Puppet']:
+    def get_cached_by_mxid(cls, mxid: UserID) -> Optional['Puppet']:
+        twid = cls.get_twid_from_mxid(mxid)
+        if twid:
+            return cls.by_twid.get(twid)
+        return None
+
+    @classmethod
+    async def get_by_mxid(cls, mxid: UserID, create: bool = True) -> Optional['Puppet']:
         twid = cls.get_twid_from_mxid(mxid)
         if twid:
-            return cls.get_by_twid(twid, create)
+            return await cls.get_by_twid(twid, create)
 
         return None
 
     @classmethod
     def get_twid_from_mxid(cls, mxid: UserID) -> Optional[TwilioUserID]:
+        twid = cls.twid_by_mxid.get(mxid, _NOT_CACHED)
+        if twid is not _NOT_CACHED:
+            return twid
         parsed = cls.mxid_template.parse(mxid)
-        if parsed:
-            return TwilioUserID(cls.twid_template.format_full(parsed))
-        return None
+        twid = TwilioUserID(cls.twid_template.format_full(parsed)) if parsed else None
+        # Negative results are cached too, since most senders the bridge sees aren't puppets
+        cls.twid_by_mxid[mxid] = twid
+        return twid
 
     @classmethod
     def get_mxid_from_twid(cls, twid: TwilioUserID) -> UserID:
@@ -137,6 +272,12 @@ def init(context: 'Context') -> None:
     global config
     Puppet.az, config, Puppet.loop = context.core
     Puppet.mx = context.mx
+    Puppet.by_twid = BoundedRegistry("puppet", max_size=config["bridge.cache.puppet.max_size"],
+                                     idle_timeout=config["bridge.cache.puppet.idle_timeout"],
+                                     can_evict=lambda puppet: not puppet.is_busy)
+    Puppet.twid_by_mxid = LRUCache(config["bridge.cache.puppet.max_size"])
+    Puppet.registered_cache = LRUCache(config["bridge.cache.puppet.max_size"])
+    Puppet.displayname_sync_concurrency = config["bridge.displayname_sync_concurrency"]
     Puppet.hs_domain = config["homeserver"]["domain"]
     Puppet.mxid_template = SimpleTemplate(config["bridge.username_template"], "userid",
                                           prefix="@", suffix=f":{Puppet.hs_domain}", type=str)
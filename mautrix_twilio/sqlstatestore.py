@@ -16,20 +16,38 @@
 from mautrix.types import UserID
 from mautrix.bridge.db import SQLStateStore as BaseSQLStateStore
 
+from .db import Puppet as DBPuppet
 from . import puppet as pu
 
 
 class SQLStateStore(BaseSQLStateStore):
+    # The state store interface is synchronous, so the puppet table is queried directly for
+    # puppets that aren't loaded, like the base class does for other users. The result is
+    # cached, so that the query only blocks the event loop once per puppet.
+
     def is_registered(self, user_id: UserID) -> bool:
-        puppet = pu.Puppet.get_by_mxid(user_id, create=False)
+        twid = pu.Puppet.get_twid_from_mxid(user_id)
+        if not twid:
+            return super().is_registered(user_id)
+        puppet = pu.Puppet.by_twid.peek(twid)
         if puppet:
             return puppet.is_registered
-        return super().is_registered(user_id)
+        registered = pu.Puppet.registered_cache.get(user_id)
+        if registered is None:
+            registered = DBPuppet.is_registered(twid)
+            if registered is None:
+                registered = super().is_registered(user_id)
+            pu.Puppet.registered_cache[user_id] = registered
+        return registered
 
     def registered(self, user_id: UserID) -> None:
-        puppet = pu.Puppet.get_by_mxid(user_id, create=True)
+        twid = pu.Puppet.get_twid_from_mxid(user_id)
+        if not twid:
+            super().registered(user_id)
+            return
+        pu.Puppet.registered_cache[user_id] = True
+        puppet = pu.Puppet.by_twid.peek(twid)
         if puppet:
             puppet.is_registered = True
-            puppet.save()
-        else:
+        if not DBPuppet.mark_registered(twid):
             super().registered(user_id)
@@ -1,4 +1,5 @@
 from .data import (TwilioUserID, TwilioMessageID, TwilioMessageEvent, TwilioStatusEvent,
-                   TwilioMessageStatus)
+                   TwilioMessageStatus, TwilioMedia)
+from .errors import TwilioError
 from .api import TwilioClient
 from .webhook import TwilioHandler
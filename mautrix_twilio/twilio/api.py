@@ -13,31 +13,71 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Dict, Optional
+from typing import Any, Dict, Optional
 import asyncio
 import logging
 
-from aiohttp import ClientSession, BasicAuth
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, BasicAuth
 
 from .data import TwilioUserID, TwilioAccountID
+from .errors import TwilioError
+from .scheduler import OutboundScheduler
 from ..config import Config
 
 
 class TwilioClient:
     log: logging.Logger = logging.getLogger("twilio.out")
-    base_url: str = "https://api.twilio.com/2010-04-01"
+    base_url: str
     http: ClientSession
+    media_http: ClientSession
+    scheduler: OutboundScheduler
     sender_id: TwilioUserID
     account_id: TwilioAccountID
 
     def __init__(self, config: Config, loop: asyncio.AbstractEventLoop) -> None:
         self.sender_id = config["twilio.sender_id"]
         self.account_id = config["twilio.account_id"]
-        self.http = ClientSession(loop=loop, auth=BasicAuth(self.account_id,
-                                                            config["twilio.secret"]))
+        self.base_url = config["twilio.api_url"].rstrip("/")
+        auth = BasicAuth(self.account_id, config["twilio.secret"])
+        self.http = self._make_session(config["twilio.http.api"], auth, loop)
+        # Media URLs redirect to a CDN, and aiohttp would send the session's credentials there
+        # too, so the media session doesn't authenticate at all
+        self.media_http = self._make_session(config["twilio.http.media"], None, loop)
+        rate_limit = config["twilio.rate_limit"]
+        self.scheduler = OutboundScheduler(rate=rate_limit["messages_per_second"],
+                                           burst=rate_limit["burst"],
+                                           max_retries=rate_limit["max_retries"],
+                                           stats_interval=rate_limit["stats_interval"],
+                                           loop=loop)
+
+    @staticmethod
+    def _make_session(config: Dict[str, Any], auth: Optional[BasicAuth],
+                      loop: asyncio.AbstractEventLoop) -> ClientSession:
+        connector = TCPConnector(limit=config["limit"], limit_per_host=config["limit_per_host"],
+                                 keepalive_timeout=config["keepalive_timeout"],
+                                 ttl_dns_cache=config["dns_cache_ttl"], loop=loop)
+        timeout = ClientTimeout(sock_connect=config["connect_timeout"],
+                                sock_read=config["read_timeout"])
+        return ClientSession(loop=loop, auth=auth, connector=connector, timeout=timeout)
+
+    async def stop(self) -> None:
+        await self.scheduler.stop()
+        await self.http.close()
+        await self.media_http.close()
 
     async def send_message(self, receiver: TwilioUserID, body: Optional[str] = None,
                            media: Optional[str] = None) -> Dict[str, str]:
+        """
+        Send a message through the outbound scheduler.
+
+        Raises:
+            TwilioError: If Twilio returned an error, even after retrying.
+        """
+        return await self.scheduler.submit(receiver, lambda: self._send_message(receiver, body,
+                                                                                media))
+
+    async def _send_message(self, receiver: TwilioUserID, body: Optional[str] = None,
+                            media: Optional[str] = None) -> Dict[str, str]:
         data = {
             "From": self.sender_id,
             "To": receiver,
@@ -47,6 +87,20 @@ class TwilioClient:
         if media:
             data["MediaUrl"] = media
         self.log.debug(f"Sending message {data}")
-        resp = await self.http.post(f"{self.base_url}/Accounts/{self.account_id}/Messages.json",
-                                    data=data)
-        return await resp.json()
+        url = f"{self.base_url}/Accounts/{self.account_id}/Messages.json"
+        async with self.http.post(url, data=data) as resp:
+            if resp.status >= 400:
+                # Proxies and some Twilio errors don't return JSON, so don't check the content type
+                try:
+                    err = await resp.json(content_type=None)
+                except ValueError:
+                    err = None
+                if not isinstance(err, dict):
+                    err = {}
+                try:
+                    retry_after = float(resp.headers["Retry-After"])
+                except (KeyError, ValueError):
+                    retry_after = None
+                raise TwilioError(resp.status, err.get("code"), err.get("message", ""),
+                                  retry_after)
+            return await resp.json()
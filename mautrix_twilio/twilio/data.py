@@ -13,12 +13,11 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import NewType
+from typing import Dict, List, NewType, Optional
 
-import attr
 from attr import dataclass
 
-from mautrix.types import SerializableAttrs, SerializableEnum
+from mautrix.types import SerializableEnum
 
 TwilioMessageID = NewType('TwilioMessageID', str)
 TwilioUserID = NewType('TwilioUserID', str)
@@ -49,29 +48,50 @@ class TwilioMessageStatus(SerializableEnum):
     RECEIVED = "received"
 
 
-@dataclass
-class TwilioMedia(SerializableAttrs['TwilioMedia']):
-    mime_type: str = attr.ib(default=None, metadata={"json": "MediaContentType0"})
-    url: str = attr.ib(default=None, metadata={"json": "MediaUrl0"})
-
-
-@dataclass
-class TwilioMessageEvent(SerializableAttrs['TwilioEvent']):
-    id: TwilioMessageID = attr.ib(metadata={"json": "MessageSid"})
-    receiver: TwilioUserID = attr.ib(metadata={"json": "To"})
-    sender: TwilioUserID = attr.ib(metadata={"json": "From"})
-    status: TwilioMessageStatus = attr.ib(metadata={"json": "SmsStatus"})
-
-    body: str = attr.ib(metadata={"json": "Body"})
-    segments: str = attr.ib(metadata={"json": "NumSegments"})
-    media: TwilioMedia = attr.ib(default=None, metadata={"flatten": True})
-
-
-@dataclass
-class TwilioStatusEvent(SerializableAttrs['TwilioEvent']):
-    id: TwilioMessageID = attr.ib(metadata={"json": "MessageSid"})
-    receiver: TwilioUserID = attr.ib(metadata={"json": "To"})
-    sender: TwilioUserID = attr.ib(metadata={"json": "From"})
-    status: TwilioMessageStatus = attr.ib(metadata={"json": "SmsStatus"})
-
-    event_type: TwilioEventType = attr.ib(default=None, metadata={"json": "EventType"})
+# The webhook events are decoded by hand into slotted classes rather than with SerializableAttrs,
+# since they're flat form parameters and decoding them is on the hot path of every webhook.
+
+@dataclass(slots=True)
+class TwilioMedia:
+    mime_type: str
+    url: str
+
+
+@dataclass(slots=True)
+class TwilioMessageEvent:
+    id: TwilioMessageID
+    receiver: TwilioUserID
+    sender: TwilioUserID
+    status: TwilioMessageStatus
+
+    body: str
+    segments: str
+    media: List[TwilioMedia]
+
+    @classmethod
+    def deserialize(cls, data: Dict[str, str]) -> 'TwilioMessageEvent':
+        return cls(id=TwilioMessageID(data["MessageSid"]), receiver=TwilioUserID(data["To"]),
+                   sender=TwilioUserID(data["From"]),
+                   status=TwilioMessageStatus(data["SmsStatus"]),
+                   body=data["Body"], segments=data["NumSegments"],
+                   media=[TwilioMedia(mime_type=data[f"MediaContentType{i}"],
+                                      url=data[f"MediaUrl{i}"])
+                          for i in range(int(data.get("NumMedia") or 0))])
+
+
+@dataclass(slots=True)
+class TwilioStatusEvent:
+    id: TwilioMessageID
+    receiver: TwilioUserID
+    sender: TwilioUserID
+    status: TwilioMessageStatus
+
+    event_type: Optional[TwilioEventType] = None
+
+    @classmethod
+    def deserialize(cls, data: Dict[str, str]) -> 'TwilioStatusEvent':
+        event_type = data.get("EventType")
+        return cls(id=TwilioMessageID(data["MessageSid"]), receiver=TwilioUserID(data["To"]),
+                   sender=TwilioUserID(data["From"]),
+                   status=TwilioMessageStatus(data["SmsStatus"]),
+                   event_type=TwilioEventType(event_type) if event_type else None)
@@ -0,0 +1,36 @@
+# mautrix-twilio - A Matrix-Twilio relaybot bridge.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Optional
+
+
+class TwilioError(Exception):
+    status: int
+    code: Optional[int]
+    message: str
+    retry_after: Optional[float]
+
+    def __init__(self, status: int, code: Optional[int] = None, message: str = "",
+                 retry_after: Optional[float] = None) -> None:
+        super().__init__(f"Twilio responded with HTTP {status}"
+                         + (f" (error {code}: {message})" if code else ""))
+        self.status = status
+        self.code = code
+        self.message = message
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status == 429 or self.status >= 500
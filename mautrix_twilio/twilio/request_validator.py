@@ -17,7 +17,7 @@
 # This is based on https://github.com/twilio/twilio-python/blob/master/twilio/request_validator.py
 # with changes to remove antiquated python support and use yarl for all URL processing.
 
-from typing import Dict, Union
+from typing import Dict, Iterable, Mapping, Tuple, Union
 from hashlib import sha1, sha256
 import base64
 import hmac
@@ -25,25 +25,31 @@ import hmac
 from yarl import URL
 
 
+Params = Union[Dict[str, str], Iterable[Tuple[str, str]]]
+
+
 class RequestValidator:
     def __init__(self, token: str) -> None:
         self.token = token.encode("utf-8")
 
-    def _compute_signature(self, url: URL, params: Dict[str, str]) -> bytes:
+    def _compute_signature(self, url: URL, params: Params) -> bytes:
         """
         Compute the signature for a given request.
 
         Args:
             url: Full URI that Twilio requested on your server.
-            params: Dictionary of POST variables.
+            params: Dictionary or list of key-value pairs of POST variables. Repeated keys are
+                included with each distinct value, sorted by value.
 
         Returns:
             The computed signature.
         """
-        signature_data = str(url)
-        for key, value in sorted(params.items()):
-            signature_data += key + value
-        return hmac.new(self.token, signature_data.encode("utf-8"), sha1).digest()
+        mac = hmac.new(self.token, str(url).encode("utf-8"), sha1)
+        items = params.items() if isinstance(params, Mapping) else params
+        for key, value in sorted(set(items)):
+            mac.update(key.encode("utf-8"))
+            mac.update(value.encode("utf-8"))
+        return mac.digest()
 
     @staticmethod
     def _compute_hash(body) -> str:
@@ -58,14 +64,14 @@ class RequestValidator:
         """
         return sha256(body.encode("utf-8")).hexdigest().strip()
 
-    def validate(self, url: URL, params: Union[str, bytes, Dict[str, str]],
-                 signature: str) -> bool:
+    def validate(self, url: URL, params: Union[str, bytes, Params], signature: str) -> bool:
         """
         Validate a request from Twilio.
 
         Args:
             url: Full URI that Twilio requested on your server.
-            params: Dictionary of POST variables or string of POST body for JSON requests.
+            params: Dictionary or list of key-value pairs of POST variables, or string of POST
+                body for JSON requests.
             signature: The signature in the X-Twilio-Signature header.
 
         Returns:
@@ -0,0 +1,230 @@
+# mautrix-twilio - A Matrix-Twilio relaybot bridge.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional, Set, Tuple
+from collections import deque
+import logging
+import asyncio
+import random
+import time
+
+from aiohttp import ClientConnectorError
+
+from .errors import TwilioError
+
+Job = Callable[[], Awaitable[Any]]
+
+
+class TokenBucket:
+    rate: float
+    burst: int
+
+    _tokens: float
+    _updated: float
+    _paused_until: float
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class OutboundScheduler:
+    """
+    Runs outgoing requests through a token bucket, taking turns between keys so that one busy
+    key can't starve the others. Requests that fail with a retryable :class:`TwilioError` or
+    that couldn't connect at all are retried with jittered exponential backoff, or after the
+    delay requested by Twilio. Queue and wait time statistics are logged every
+    ``stats_interval`` seconds while there is traffic, and when the scheduler is stopped.
+    """
+    log: logging.Logger = logging.getLogger("twilio.scheduler")
+    loop: asyncio.AbstractEventLoop
+    bucket: TokenBucket
+    max_retries: int
+    base_backoff: float
+    stats_interval: float
+
+    sent: int
+    total_wait: float
+    max_wait: float
+
+    _queues: Dict[Hashable, Deque[Tuple[Job, asyncio.Future, float]]]
+    _ready: Deque[Hashable]
+    _has_items: asyncio.Event
+    _task: Optional[asyncio.Task]
+    _stats_task: Optional[asyncio.Task]
+    _tries: Set[asyncio.Task]
+
+    def __init__(self, rate: float, burst: int, max_retries: int, base_backoff: float = 1,
+                 stats_interval: float = 300,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.loop = loop or asyncio.get_event_loop()
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.stats_interval = stats_interval
+        self.sent = 0
+        self.total_wait = 0
+        self.max_wait = 0
+        self._queues = {}
+        self._ready = deque()
+        self._has_items = asyncio.Event()
+        self._task = None
+        self._stats_task = None
+        self._tries = set()
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        return {
+            "queue_depth": self.queue_depth,
+            "queued_keys": len(self._queues),
+            "sent": self.sent,
+            "avg_wait": self.total_wait / self.sent if self.sent else 0,
+            "max_wait": self.max_wait,
+        }
+
+    def log_stats(self) -> None:
+        stats = self.stats
+        self.log.info(f"Sent {stats['sent']} requests, {stats['queue_depth']} queued for "
+                      f"{stats['queued_keys']} keys, waited {stats['avg_wait']:.2f}s on average "
+                      f"and {stats['max_wait']:.2f}s at most")
+
+    async def _log_stats_periodically(self) -> None:
+        logged_sent = 0
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            if self.sent != logged_sent or self.queue_depth > 0:
+                logged_sent = self.sent
+                self.log_stats()
+
+    def submit(self, key: Hashable, job: Job) -> asyncio.Future:
+        """
+        Queue a request.
+
+        Args:
+            key: The fairness key, e.g. the receiver of the message.
+            job: A function that returns the awaitable that makes the request.
+
+        Returns:
+            A future that resolves to the result of the job.
+        """
+        if not self._task:
+            self._task = self.loop.create_task(self._run())
+            if self.stats_interval > 0:
+                self._stats_task = self.loop.create_task(self._log_stats_periodically())
+        fut = self.loop.create_future()
+        try:
+            queue = self._queues[key]
+        except KeyError:
+            queue = self._queues[key] = deque()
+            self._ready.append(key)
+        queue.append((job, fut, time.monotonic()))
+        self._has_items.set()
+        return fut
+
+    def _next(self) -> Tuple[Job, asyncio.Future, float]:
+        key = self._ready.popleft()
+        queue = self._queues[key]
+        item = queue.popleft()
+        if queue:
+            self._ready.append(key)
+        else:
+            del self._queues[key]
+            if not self._ready:
+                self._has_items.clear()
+        return item
+
+    async def _run(self) -> None:
+        while True:
+            await self._has_items.wait()
+            await self.bucket.acquire()
+            job, fut, queued_at = self._next()
+            wait = time.monotonic() - queued_at
+            self.sent += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            task = self.loop.create_task(self._try(job, fut))
+            self._tries.add(task)
+            task.add_done_callback(self._tries.discard)
+
+    async def _try(self, job: Job, fut: asyncio.Future) -> None:
+        attempt = 0
+        while True:
+            try:
+                result = await job()
+            except asyncio.CancelledError:
+                fut.cancel()
+                raise
+            # Sending isn't idempotent, so other connection errors and timeouts aren't retried,
+            # since Twilio may have accepted the message before the connection broke
+            except (TwilioError, ClientConnectorError) as e:
+                attempt += 1
+                retryable = e.retryable if isinstance(e, TwilioError) else True
+                if not retryable or attempt > self.max_retries:
+                    if not fut.cancelled():
+                        fut.set_exception(e)
+                    return
+                if isinstance(e, TwilioError) and e.retry_after is not None:
+                    delay = e.retry_after
+                    self.bucket.pause(delay)
+                else:
+                    delay = random.uniform(0, self.base_backoff * 2 ** attempt)
+                self.log.warning(f"{str(e) or type(e).__name__}, retrying in {delay:.2f} "
+                                 f"seconds (attempt {attempt}/{self.max_retries})")
+                await asyncio.sleep(delay)
+                await self.bucket.acquire()
+            except Exception as e:
+                if not fut.cancelled():
+                    fut.set_exception(e)
+                return
+            else:
+                if not fut.cancelled():
+                    fut.set_result(result)
+                return
+
+    async def stop(self) -> None:
+        tasks = [task for task in (self._task, self._stats_task, *self._tries) if task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = self._stats_task = None
+        if self.sent > 0:
+            self.log_stats()
@@ -13,24 +13,36 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, Tuple, Any, TYPE_CHECKING
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+from urllib.parse import parse_qsl
 import logging
 import asyncio
 
 from aiohttp import web
 
 from .request_validator import RequestValidator
-from .data import TwilioMessageEvent, TwilioStatusEvent
+from .data import TwilioUserID, TwilioMessageID, TwilioMessageEvent, TwilioStatusEvent
+from ..db import InboundEvent as DBInboundEvent
+from ..util import KeyedDispatcher, LRUCache
 from .. import portal as po
 
 if TYPE_CHECKING:
     from ..context import Context
 
+EVENT_MESSAGE = "message"
+EVENT_STATUS = "status"
+
 
 class TwilioHandler:
     log: logging.Logger = logging.getLogger("twilio.in")
     app: web.Application
     validator: RequestValidator
+    dispatcher: KeyedDispatcher
+    recent_messages: LRUCache[TwilioMessageID, bool]
+    _in_flight: Dict[TwilioMessageID, asyncio.Future]
+
+    async_webhooks: bool
+    async_webhook_retries: int
 
     def __init__(self, context: 'Context') -> None:
         self.loop = context.loop or asyncio.get_event_loop()
@@ -38,33 +50,136 @@ class TwilioHandler:
         self.app.router.add_route("POST", "/receive", self.receive)
         self.app.router.add_route("POST", "/status", self.status)
         self.validator = RequestValidator(token=context.config["twilio.secret"])
+        self.async_webhooks = context.config["twilio.async_webhooks"]
+        self.async_webhook_retries = context.config["twilio.async_webhook_retries"]
+        self.dispatcher = KeyedDispatcher(
+            concurrency=context.config["twilio.max_concurrent_portals"],
+            idle_timeout=context.config["twilio.portal_worker_idle_timeout"], loop=self.loop)
+        self.recent_messages = LRUCache(context.config["twilio.dedup_cache_size"])
+        self._in_flight = {}
+
+    async def start(self) -> None:
+        if not self.async_webhooks:
+            return
+        pending = 0
+        for evt in await DBInboundEvent.all():
+            if evt.type == EVENT_MESSAGE:
+                self.recent_messages[TwilioMessageID(evt.params.get("MessageSid", ""))] = True
+            self._dispatch_queued(evt)
+            pending += 1
+        if pending > 0:
+            self.log.info(f"Replaying {pending} queued Twilio events")
+
+    async def stop(self) -> None:
+        await self.dispatcher.stop()
+
+    @staticmethod
+    def _get_portal_twid(evt_type: str, data: Dict[str, str]) -> TwilioUserID:
+        return TwilioUserID(data.get("From" if evt_type == EVENT_MESSAGE else "To", ""))
 
-    async def _validate_request(self, request: web.Request, type_class: Any
-                                ) -> Tuple[Any, Optional[web.Response]]:
-        data = dict(**await request.post())
+    def _dispatch_queued(self, evt: DBInboundEvent) -> None:
+        params = evt.params
+
+        async def process() -> None:
+            # Retrying here keeps the rest of the conversation waiting, so events stay in order
+            for attempt in range(self.async_webhook_retries + 1):
+                if attempt > 0:
+                    await asyncio.sleep(2 ** attempt)
+                try:
+                    await self._process(evt.type, params)
+                except Exception:
+                    self.log.exception(f"Failed to process queued {evt.type} event #{evt.id} "
+                                       f"(attempt {attempt + 1})")
+                else:
+                    await evt.delete()
+                    return
+            self.log.error(f"Giving up on queued {evt.type} event #{evt.id} until the bridge is "
+                           "restarted")
+
+        self.dispatcher.dispatch(self._get_portal_twid(evt.type, params), process)
+
+    @staticmethod
+    def _parse_form(body: bytes) -> List[Tuple[str, str]]:
+        return parse_qsl(body.decode("utf-8"), keep_blank_values=True)
+
+    async def _validate_request(self, request: web.Request
+                                ) -> Tuple[Optional[Dict[str, str]], Optional[web.Response]]:
         try:
             signature = request.headers["X-Twilio-Signature"]
         except KeyError:
             return None, web.Response(status=400, text="Missing signature")
-        is_valid = self.validator.validate(request.url, data, signature)
-        if not is_valid:
+        try:
+            params = self._parse_form(await request.read())
+        except UnicodeDecodeError:
+            return None, web.Response(status=400, text="Invalid request body")
+        if not self.validator.validate(request.url, params, signature):
             return None, web.Response(status=401, text="Invalid signature")
-        return type_class.deserialize(data), None
+        # The signature covers every value of repeated keys, but the events only use the first
+        data = {}
+        for key, value in params:
+            data.setdefault(key, value)
+        return data, None
 
-    async def receive(self, request: web.Request) -> web.Response:
-        data, err = await self._validate_request(request, TwilioMessageEvent)
+    async def _handle(self, request: web.Request, evt_type: str) -> web.Response:
+        data, err = await self._validate_request(request)
         if err is not None:
             return err
-        self.log.debug(f"Received Twilio message event: {data}")
-        portal = po.Portal.get_by_twid(data.sender)
-        await portal.handle_twilio_message(data)
+        sid = TwilioMessageID(data.get("MessageSid", "")) if evt_type == EVENT_MESSAGE else None
+        if not sid:
+            await self._deliver(evt_type, data)
+            return web.Response(status=204)
+        while True:
+            if sid in self.recent_messages:
+                self.log.debug(f"Ignoring duplicate delivery of {sid}")
+                return web.Response(status=204)
+            in_flight = self._in_flight.get(sid)
+            if not in_flight:
+                break
+            # If the first delivery fails, this one tries again instead of being dropped
+            self.log.debug(f"Waiting for in-flight delivery of {sid}")
+            await asyncio.wait([in_flight])
+        fut = self._in_flight[sid] = self._deliver(evt_type, data)
+        fut.add_done_callback(lambda _: self._finish_delivery(sid, fut))
+        # The event is still being processed even if the request is cancelled
+        await asyncio.shield(fut)
         return web.Response(status=204)
 
+    def _deliver(self, evt_type: str, data: Dict[str, str]) -> asyncio.Future:
+        if self.async_webhooks:
+            return asyncio.ensure_future(self._queue(evt_type, data), loop=self.loop)
+        return self.dispatcher.dispatch(self._get_portal_twid(evt_type, data),
+                                        lambda: self._process(evt_type, data))
+
+    async def _queue(self, evt_type: str, data: Dict[str, str]) -> None:
+        self._dispatch_queued(await DBInboundEvent.create(evt_type, data))
+
+    def _finish_delivery(self, sid: TwilioMessageID, fut: asyncio.Future) -> None:
+        if self._in_flight.get(sid) is fut:
+            del self._in_flight[sid]
+        # Only successful deliveries are deduplicated, so that Twilio's retry can bridge
+        # the message if processing failed
+        if not fut.cancelled() and fut.exception() is None:
+            self.recent_messages[sid] = True
+
+    async def _process(self, evt_type: str, data: Dict[str, str]) -> None:
+        if evt_type == EVENT_MESSAGE:
+            message = TwilioMessageEvent.deserialize(data)
+            self.log.debug(f"Received Twilio message event: {message}")
+            portal = await po.Portal.get_by_twid(message.sender)
+            await portal.handle_twilio_message(message)
+        elif evt_type == EVENT_STATUS:
+            status = TwilioStatusEvent.deserialize(data)
+            self.log.debug(f"Received Twilio status event: {status}")
+            portal = await po.Portal.get_by_twid(status.receiver, create=False)
+            if not portal:
+                self.log.debug(f"Ignoring status event for unknown portal {status.receiver}")
+                return
+            await portal.handle_twilio_status(status)
+        else:
+            self.log.warning(f"Unknown inbound event type {evt_type}")
+
+    async def receive(self, request: web.Request) -> web.Response:
+        return await self._handle(request, EVENT_MESSAGE)
+
     async def status(self, request: web.Request) -> web.Response:
-        data, err = await self._validate_request(request, TwilioStatusEvent)
-        if err is not None:
-            return err
-        self.log.debug(f"Received Twilio status event: {data}")
-        portal = po.Portal.get_by_twid(data.receiver)
-        await portal.handle_twilio_status(data)
-        return web.Response(status=204)
+        return await self._handle(request, EVENT_STATUS)
@@ -13,13 +13,14 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Dict, Optional, TYPE_CHECKING
+from typing import Optional, TYPE_CHECKING
 
 from mautrix.types import UserID
 from mautrix.bridge import BaseUser
 
 from . import puppet as pu
 from .config import Config
+from .util import BoundedRegistry, EntityLogger
 
 if TYPE_CHECKING:
     from .context import Context
@@ -28,7 +29,7 @@ config: Config
 
 
 class User(BaseUser):
-    by_mxid: Dict[UserID, 'User'] = {}
+    by_mxid: BoundedRegistry[UserID, 'User']
 
     is_whitelisted: bool
     is_admin: bool
@@ -36,10 +37,10 @@ class User(BaseUser):
     def __init__(self, mxid: UserID) -> None:
         super().__init__()
         self.mxid = mxid
-        self.by_mxid[self.mxid] = self
         self.command_status = None
         self.is_whitelisted, self.is_admin = config.get_permissions(self.mxid)
-        self.log = self.log.getChild(self.mxid)
+        self.log = EntityLogger(self.log, self.mxid)
+        self.by_mxid[self.mxid] = self
 
     @classmethod
     def get(cls, mxid: UserID) -> Optional['User']:
@@ -54,3 +55,7 @@ class User(BaseUser):
 def init(context: 'Context') -> None:
     global config
     User.az, config, User.loop = context.core
+    User.by_mxid = BoundedRegistry("user", max_size=config["bridge.cache.user.max_size"],
+                                   idle_timeout=config["bridge.cache.user.idle_timeout"],
+                                   # Unloading would lose the state of multi-step commands
+                                   can_evict=lambda user: user.command_status is None)
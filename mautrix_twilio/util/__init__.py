@@ -1 +1,8 @@
 from .color_log import ColorFormatter
+from .log import EntityLogger
+from .dispatcher import KeyedDispatcher
+from .lru import LRUCache
+from .correlation import CorrelationIndex
+from .registry import BoundedRegistry
+from .media import relay_media, MediaCache, MediaTooLargeError
+from .room_pool import RoomPool
@@ -0,0 +1,72 @@
+# mautrix-twilio - A Matrix-Twilio relaybot bridge.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Generic, Hashable, List, Optional, TypeVar
+import asyncio
+
+from .lru import LRUCache
+
+KT = TypeVar("KT", bound=Hashable)
+VT = TypeVar("VT")
+
+
+class CorrelationIndex(Generic[KT, VT]):
+    """
+    A bounded index of recently seen keys, which also allows waiting for a key that hasn't been
+    added yet.
+    """
+    loop: asyncio.AbstractEventLoop
+
+    _cache: LRUCache[KT, VT]
+    _waiters: Dict[KT, List[asyncio.Future]]
+
+    def __init__(self, max_size: int, loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.loop = loop or asyncio.get_event_loop()
+        self._cache = LRUCache(max_size)
+        self._waiters = {}
+
+    def put(self, key: KT, value: VT) -> None:
+        self._cache[key] = value
+        for fut in self._waiters.pop(key, []):
+            if not fut.done():
+                fut.set_result(value)
+
+    def get(self, key: KT) -> Optional[VT]:
+        return self._cache.get(key)
+
+    async def wait(self, key: KT, timeout: float) -> Optional[VT]:
+        """
+        Get the value of a key, waiting up to ``timeout`` seconds for it to be added.
+
+        Returns:
+            The value, or ``None`` if the key wasn't added in time.
+        """
+        value = self._cache.get(key)
+        if value is not None:
+            return value
+        fut = self.loop.create_future()
+        waiters = self._waiters.setdefault(key, [])
+        waiters.append(fut)
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            try:
+                waiters.remove(fut)
+            except ValueError:
+                pass
+            if not waiters and self._waiters.get(key) is waiters:
+                del self._waiters[key]
@@ -0,0 +1,110 @@
+# mautrix-twilio - A Matrix-Twilio relaybot bridge.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+import asyncio
+
+Job = Callable[[], Awaitable[Any]]
+
+
+class KeyedDispatcher:
+    """
+    Runs jobs in strict order for each key, while jobs with different keys run in parallel.
+
+    Each key gets its own worker task, which is stopped after it has been idle for
+    ``idle_timeout`` seconds. The number of jobs running at the same time across all keys is
+    capped by ``concurrency``.
+    """
+    loop: asyncio.AbstractEventLoop
+    idle_timeout: float
+
+    _semaphore: asyncio.Semaphore
+    _queues: Dict[Hashable, 'asyncio.Queue[Tuple[Job, asyncio.Future]]']
+    _workers: Dict[Hashable, asyncio.Task]
+
+    def __init__(self, concurrency: int, idle_timeout: float,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.loop = loop or asyncio.get_event_loop()
+        self.idle_timeout = idle_timeout
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._queues = {}
+        self._workers = {}
+
+    @property
+    def active_keys(self) -> int:
+        return len(self._workers)
+
+    @property
+    def pending_jobs(self) -> int:
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    def is_active(self, key: Hashable) -> bool:
+        return key in self._workers
+
+    def dispatch(self, key: Hashable, job: Job) -> asyncio.Future:
+        """
+        Schedule a job to run after all previously dispatched jobs with the same key.
+
+        Args:
+            key: The key that determines ordering, e.g. the Twilio ID of a portal.
+            job: A function that returns the awaitable to run.
+
+        Returns:
+            A future that resolves to the result of the job.
+        """
+        fut = self.loop.create_future()
+        try:
+            queue = self._queues[key]
+        except KeyError:
+            queue = self._queues[key] = asyncio.Queue()
+            self._workers[key] = self.loop.create_task(self._worker(key, queue))
+        queue.put_nowait((job, fut))
+        return fut
+
+    async def _worker(self, key: Hashable,
+                      queue: 'asyncio.Queue[Tuple[Job, asyncio.Future]]') -> None:
+        try:
+            while True:
+                try:
+                    job, fut = await asyncio.wait_for(queue.get(), timeout=self.idle_timeout)
+                except asyncio.TimeoutError:
+                    if queue.empty():
+                        return
+                    continue
+                async with self._semaphore:
+                    try:
+                        result = await job()
+                    except asyncio.CancelledError:
+                        fut.cancel()
+                        raise
+                    except Exception as e:
+                        if not fut.cancelled():
+                            fut.set_exception(e)
+                    else:
+                        if not fut.cancelled():
+                            fut.set_result(result)
+        finally:
+            del self._queues[key]
+            del self._workers[key]
+            while not queue.empty():
+                _, fut = queue.get_nowait()
+                fut.cancel()
+
+    async def stop(self) -> None:
+        workers = list(self._workers.values())
+        for worker in workers:
+            worker.cancel()
+        if workers:
+            await asyncio.gather(*workers, return_exceptions=True)
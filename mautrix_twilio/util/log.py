@@ -0,0 +1,35 @@
+# mautrix-twilio - A Matrix-Twilio relaybot bridge.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Dict, MutableMapping, Tuple
+import logging
+
+
+class EntityLogger(logging.LoggerAdapter):
+    """
+    Prefixes log messages with the ID of a portal, puppet or user.
+
+    Unlike :meth:`logging.Logger.getChild`, this doesn't register a new logger in the logging
+    module, so the adapter is freed along with the object that owns it.
+    """
+
+    def __init__(self, logger: logging.Logger, entity_id: str) -> None:
+        super().__init__(logger, {"entity_id": entity_id})
+
+    def process(self, msg: Any, kwargs: MutableMapping[str, Any]
+                ) -> Tuple[Any, MutableMapping[str, Any]]:
+        extra: Dict[str, Any] = kwargs.get("extra") or {}
+        kwargs["extra"] = {**self.extra, **extra}
+        return f"[{self.extra['entity_id']}] {msg}", kwargs
@@ -0,0 +1,177 @@
+# mautrix-twilio - A Matrix-Twilio relaybot bridge.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import AsyncIterator, Optional, Tuple
+from hashlib import sha256
+import logging
+import asyncio
+import time
+
+from aiohttp import ClientSession
+from sqlalchemy.exc import IntegrityError
+
+from mautrix.types import ContentURI
+from mautrix.appservice import IntentAPI
+
+from ..db import MediaCache as DBMediaCache
+from .lru import LRUCache
+
+CHUNK_SIZE = 64 * 1024
+
+MediaKey = Tuple[str, str, int]
+
+
+class MediaCache:
+    """
+    A content-addressed cache of media that has already been uploaded to the homeserver.
+
+    Entries are stored in the database and the most recently used ones are also kept in memory.
+    """
+    log: logging.Logger = logging.getLogger("mau.media_cache")
+    loop: asyncio.AbstractEventLoop
+
+    max_file_size: int
+    retention: int
+    hits: int
+    misses: int
+
+    _memory: LRUCache[MediaKey, Tuple[ContentURI, int]]
+    _evict_task: Optional[asyncio.Task]
+
+    def __init__(self, max_file_size: int, memory_size: int, retention: int,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.loop = loop or asyncio.get_event_loop()
+        self.max_file_size = max_file_size
+        self.retention = retention
+        self.hits = 0
+        self.misses = 0
+        self._memory = LRUCache(memory_size)
+        self._evict_task = None
+
+    def _is_expired(self, created_at: int) -> bool:
+        return self.retention > 0 and created_at < time.time() - self.retention
+
+    async def get(self, key: MediaKey) -> Optional[ContentURI]:
+        cached = self._memory.get(key)
+        if cached is None:
+            entry = await DBMediaCache.get(*key)
+            if entry:
+                cached = self._memory[key] = entry.mxc, entry.created_at
+        if cached is None or self._is_expired(cached[1]):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cached[0]
+
+    async def put(self, key: MediaKey, mxc: ContentURI) -> None:
+        expired_before = int(time.time() - self.retention) if self.retention > 0 else 0
+        try:
+            entry = await DBMediaCache.create(*key, mxc, expired_before=expired_before)
+        except IntegrityError:
+            # The same file was uploaded concurrently, just keep the first one
+            entry = await DBMediaCache.get(*key)
+            if not entry:
+                return
+        self._memory[key] = entry.mxc, entry.created_at
+
+    async def evict_expired(self) -> None:
+        if self.retention <= 0:
+            return
+        deleted = await DBMediaCache.delete_older_than(int(time.time() - self.retention))
+        self.log.debug(f"Evicted {deleted} expired media cache entries "
+                       f"({self.hits} hits, {self.misses} misses since startup)")
+
+    async def _evict_loop(self) -> None:
+        while True:
+            try:
+                await self.evict_expired()
+            except Exception:
+                self.log.exception("Failed to evict expired media cache entries")
+            await asyncio.sleep(60 * 60)
+
+    async def start(self) -> None:
+        self._evict_task = self.loop.create_task(self._evict_loop())
+
+    async def stop(self) -> None:
+        if self._evict_task:
+            self._evict_task.cancel()
+            self._evict_task = None
+
+
+class MediaTooLargeError(Exception):
+    def __init__(self, max_size: int) -> None:
+        super().__init__(f"Media is larger than the maximum size of {max_size} bytes")
+        self.max_size = max_size
+
+
+async def _upload_cached(intent: IntentAPI, data: bytes, mime_type: str, cache: MediaCache
+                         ) -> ContentURI:
+    key = (sha256(data).hexdigest(), mime_type, len(data))
+    mxc = await cache.get(key)
+    if not mxc:
+        mxc = await intent.upload_media(data, mime_type)
+        await cache.put(key, mxc)
+    return mxc
+
+
+async def relay_media(http: ClientSession, url: str, intent: IntentAPI, mime_type: str,
+                      max_size: int = 0, cache: Optional[MediaCache] = None
+                      ) -> Tuple[ContentURI, int]:
+    """
+    Stream media from a URL directly into the media repo of the homeserver.
+
+    The body is forwarded in chunks as it's downloaded, so at most a few chunks are held in
+    memory at a time, regardless of the size of the file.
+
+    Args:
+        http: The HTTP session to download the media with.
+        url: The URL to download.
+        intent: The intent to upload the media as.
+        mime_type: The mime type of the media.
+        max_size: The maximum size of the media in bytes, or 0 for no limit.
+        cache: The media cache to deduplicate uploads with. Files that are small enough to be
+               cached are read into memory and hashed instead of being streamed.
+
+    Returns:
+        The ``mxc://`` URI of the uploaded media and its size in bytes.
+
+    Raises:
+        MediaTooLargeError: If the media is larger than ``max_size``.
+    """
+    size = 0
+    async with http.get(url) as resp:
+        resp.raise_for_status()
+        if max_size and resp.content_length and resp.content_length > max_size:
+            raise MediaTooLargeError(max_size)
+        if cache and resp.content_length and resp.content_length <= cache.max_file_size:
+            data = await resp.read()
+            return await _upload_cached(intent, data, mime_type, cache), len(data)
+
+        async def read() -> AsyncIterator[bytes]:
+            nonlocal size
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise MediaTooLargeError(max_size)
+                yield chunk
+
+        try:
+            mxc = await intent.upload_media(read(), mime_type, size=resp.content_length)
+        except Exception:
+            # aiohttp may wrap errors raised while writing the request body
+            if max_size and size > max_size:
+                raise MediaTooLargeError(max_size)
+            raise
+    return mxc, size
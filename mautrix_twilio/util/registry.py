@@ -0,0 +1,141 @@
+# mautrix-twilio - A Matrix-Twilio relaybot bridge.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Callable, Generic, Hashable, Iterable, Optional, Tuple, TypeVar
+from collections import OrderedDict
+import logging
+import asyncio
+import time
+
+KT = TypeVar("KT", bound=Hashable)
+VT = TypeVar("VT")
+
+
+class BoundedRegistry(Generic[KT, VT]):
+    """
+    An in-memory registry of loaded objects with a maximum size. The least recently used entries
+    are unloaded when the registry is full, and entries that haven't been used for
+    ``idle_timeout`` seconds are unloaded by :meth:`evict_idle`. Entries for which ``can_evict``
+    returns ``False`` are never unloaded.
+    """
+    log: logging.Logger = logging.getLogger("mau.registry")
+
+    name: str
+    max_size: int
+    idle_timeout: float
+    hits: int
+    misses: int
+    evictions: int
+
+    _data: 'OrderedDict[KT, Tuple[VT, float]]'
+    _can_evict: Optional[Callable[[VT], bool]]
+    _on_evict: Optional[Callable[[VT], None]]
+    _sweep_task: Optional[asyncio.Task]
+
+    def __init__(self, name: str, max_size: int, idle_timeout: float,
+                 can_evict: Optional[Callable[[VT], bool]] = None,
+                 on_evict: Optional[Callable[[VT], None]] = None) -> None:
+        self.name = name
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._can_evict = can_evict
+        self._on_evict = on_evict
+        self._sweep_task = None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: KT) -> bool:
+        return key in self._data
+
+    def __getitem__(self, key: KT) -> VT:
+        try:
+            value, _ = self._data[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self._data[key] = value, time.monotonic()
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def get(self, key: KT, default: Optional[VT] = None) -> Optional[VT]:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def peek(self, key: KT) -> Optional[VT]:
+        """Get an entry without marking it as used or counting the lookup."""
+        try:
+            value, _ = self._data[key]
+        except KeyError:
+            return None
+        return value
+
+    def __setitem__(self, key: KT, value: VT) -> None:
+        self._data[key] = value, time.monotonic()
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_size:
+            self._evict(len(self._data) - self.max_size, lambda last_used: True)
+
+    def pop(self, key: KT, default: Optional[VT] = None) -> Optional[VT]:
+        try:
+            value, _ = self._data.pop(key)
+        except KeyError:
+            return default
+        return value
+
+    def values(self) -> Iterable[VT]:
+        return (value for value, _ in self._data.values())
+
+    def _evict(self, limit: int, should_evict: Callable[[float], bool]) -> int:
+        evicted = 0
+        # Entries are ordered from least to most recently used
+        for key, (value, last_used) in list(self._data.items()):
+            if evicted >= limit or not should_evict(last_used):
+                break
+            if self._can_evict and not self._can_evict(value):
+                continue
+            del self._data[key]
+            if self._on_evict:
+                self._on_evict(value)
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def evict_idle(self) -> int:
+        cutoff = time.monotonic() - self.idle_timeout
+        return self._evict(len(self._data), lambda last_used: last_used < cutoff)
+
+    async def _sweep_loop(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            evicted = self.evict_idle()
+            self.log.debug(f"Unloaded {evicted} idle {self.name}s, {len(self)} still loaded "
+                           f"({self.hits} hits, {self.misses} misses, "
+                           f"{self.evictions} evictions since startup)")
+
+    async def start(self, loop: asyncio.AbstractEventLoop, interval: float = 60) -> None:
+        self._sweep_task = loop.create_task(self._sweep_loop(interval))
+
+    async def stop(self) -> None:
+        if self._sweep_task:
+            self._sweep_task.cancel()
+            self._sweep_task = None
@@ -0,0 +1,111 @@
+# mautrix-twilio - A Matrix-Twilio relaybot bridge.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Deque, Dict, List, Optional
+from collections import deque
+import logging
+import asyncio
+
+from mautrix.types import RoomID, UserID, StrippedStateEvent
+from mautrix.appservice import AppService, IntentAPI
+
+from ..db import PooledRoom
+
+
+class RoomPool:
+    """
+    A pool of rooms that are created in advance by the bridge bot, so that new portals can claim
+    a room instead of waiting for it to be created.
+
+    The pool is refilled in the background whenever a room is claimed. Rooms that haven't been
+    claimed yet are stored in the database, so they're reused after restarting.
+    """
+    log: logging.Logger = logging.getLogger("mau.room_pool")
+    loop: asyncio.AbstractEventLoop
+
+    az: AppService
+    intent: Optional[IntentAPI]
+    size: int
+    retry_delay: float
+    creation_content: Dict[str, Any]
+    initial_state: List[StrippedStateEvent]
+    invitees: List[UserID]
+
+    _rooms: Deque[RoomID]
+    _refill: asyncio.Event
+    _refill_task: Optional[asyncio.Task]
+
+    def __init__(self, az: AppService, size: int, creation_content: Dict[str, Any],
+                 initial_state: List[StrippedStateEvent], invitees: List[UserID],
+                 retry_delay: float = 60, loop: Optional[asyncio.AbstractEventLoop] = None
+                 ) -> None:
+        self.loop = loop or asyncio.get_event_loop()
+        self.az = az
+        # The appservice intent only exists after the appservice has been started
+        self.intent = None
+        self.size = size
+        self.retry_delay = retry_delay
+        self.creation_content = creation_content
+        self.initial_state = initial_state
+        self.invitees = invitees
+        self._rooms = deque()
+        self._refill = asyncio.Event()
+        self._refill_task = None
+
+    def __len__(self) -> int:
+        return len(self._rooms)
+
+    async def claim(self) -> Optional[RoomID]:
+        """Take a room out of the pool, or return ``None`` if the pool is empty."""
+        self._refill.set()
+        if not self._rooms:
+            return None
+        mxid = self._rooms.popleft()
+        await PooledRoom(mxid=mxid).delete()
+        return mxid
+
+    async def _create_room(self) -> None:
+        mxid = await self.intent.create_room(invitees=self.invitees,
+                                             creation_content=self.creation_content,
+                                             initial_state=self.initial_state)
+        if not mxid:
+            raise Exception("Failed to create room: no mxid received")
+        await PooledRoom(mxid=mxid).insert()
+        self._rooms.append(mxid)
+
+    async def _refill_loop(self) -> None:
+        while True:
+            await self._refill.wait()
+            self._refill.clear()
+            while len(self._rooms) < self.size:
+                try:
+                    await self._create_room()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.log.exception("Failed to create room for the pool")
+                    await asyncio.sleep(self.retry_delay)
+
+    async def start(self) -> None:
+        self.intent = self.az.intent
+        self._rooms.extend(room.mxid for room in await PooledRoom.all())
+        self.log.debug(f"Loaded {len(self._rooms)} rooms, filling pool up to {self.size}")
+        self._refill.set()
+        self._refill_task = self.loop.create_task(self._refill_loop())
+
+    async def stop(self) -> None:
+        if self._refill_task:
+            self._refill_task.cancel()
+            self._refill_task = None